@@ -0,0 +1,304 @@
+"""
+ Benchmarks for the python path of SAA.
+ A synthetic BIDS tree (sourcedata/sub-XX/ses-YY/fmri/data.tsv, with the
+ description, decoding sets and cfg files that go with it) is generated for
+ every combination of the size parameters, and each stage is timed on its own:
+ tsv loading, preparation, decoding (per decoder backend and per number of
+ parallel jobs), statistics and plotting. The timings are written as JSON.
+ --check_decoders instead cross-checks the decoder backends on such a tree.
+
+ Example:
+     python benchmark.py --subjects 5 10 20 --decoders svc lda --n_jobs 1 4 --output bench.json
+     python benchmark.py --check_decoders
+"""
+# coding: utf-8
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# modules that the command line interface must not load before a stage needs them
+HEAVY_MODULES = ('pandas', 'scipy', 'sklearn', 'matplotlib', 'bokeh', 'matlab')
+# budget of `pySAA.py --help` in seconds, checked with --check_startup
+STARTUP_BUDGET = 0.5
+# largest accepted difference of the mean accuracy of a decoding set between
+# the batched backends and svc, checked with --check_decoders
+DECODER_TOLERANCE = 0.15
+
+
+def generate_bids(root, n_subjects=4, n_sessions=3, n_trials=40, n_variables=10, n_sets=10,
+                  n_conditions=2, seed=0):
+    """
+    Write a synthetic SAA dataset into root.
+    The conditions are coded as integers so that the simple example can decode every column.
+    Variables var001... are random, except for the first one, which is informative about the condition.
+    Returns:
+            path of the cfg JSON file
+    """
+    rng = np.random.default_rng(seed)
+    source = os.path.join(root, 'sourcedata')
+    names = ['var{0:03d}'.format(i) for i in range(1, n_variables + 1)]
+    for sub, sess in itertools.product(range(1, n_subjects + 1), range(1, n_sessions + 1)):
+        folder = os.path.join(source, 'sub-{0:02d}'.format(sub), 'ses-{0:02d}'.format(sess), 'fmri')
+        os.makedirs(folder, exist_ok=True)
+        conditions = np.arange(n_trials) % n_conditions + 1
+        values = rng.standard_normal((n_trials, n_variables))
+        values[:, 0] += 0.5 * conditions
+        with open(os.path.join(folder, 'data.tsv'), 'w') as f:
+            f.write('\t'.join(['name', 'trialnr'] + names) + '\n')
+            for trial in range(n_trials):
+                row = [str(conditions[trial]), str(trial + 1)] + ['{0:.4f}'.format(v) for v in values[trial]]
+                f.write('\t'.join(row) + '\n')
+    with open(os.path.join(root, 'description.tsv'), 'w') as f:
+        f.write('name\tn/a\tordinal\n')
+        for name in ['trialnr'] + names:
+            f.write('{0}\t0\tinterval\n'.format(name))
+    # single variables, then a regular expression and random sets of 2 to 5 variables
+    decoding_sets = [(name,) for name in names[:n_sets]] + [('regexp:^var',)]
+    for _ in range(100 * n_sets):
+        if len(decoding_sets) >= n_sets or n_variables < 2:
+            break
+        size = min(2 + len(decoding_sets) % 4, n_variables)
+        decoding_set = tuple(sorted(rng.choice(names, size=size, replace=False)))
+        # the names of the sets label the rows of the output, they must be unique
+        if decoding_set not in decoding_sets:
+            decoding_sets.append(decoding_set)
+    with open(os.path.join(root, 'analyses.tsv'), 'w') as f:
+        for decoding_set in decoding_sets[:n_sets]:
+            f.write('\t'.join(decoding_set) + '\n')
+    cfg = {
+        'path': {'value': source, 'type': 'other'},
+        'substodo': {'value': '1:{0}'.format(n_subjects), 'type': 'object'},
+        'description_file': {'value': os.path.join(root, 'description.tsv'), 'type': 'other'},
+        'decoding_sets_file': {'value': os.path.join(root, 'analyses.tsv'), 'type': 'other'},
+        'output_result': {'value': os.path.join(root, 'output', 'result.mat'), 'type': 'other'},
+    }
+    os.makedirs(os.path.join(root, 'output'), exist_ok=True)
+    cfg_file = os.path.join(root, 'cfg.json')
+    with open(cfg_file, 'w') as f:
+        json.dump(cfg, f, indent=1)
+    return cfg_file
+
+
+class Timer:
+    def __init__(self):
+        """Collect wall times of named stages"""
+        self.times = {}
+
+    def __call__(self, name, func, *args, **kwargs):
+        """Run func and store its wall time under name"""
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times[name] = time.perf_counter() - start
+        return result
+
+
+def run_case(params, decoders_to_run, n_jobs_list, n_permutations, plot, root):
+    """Generate a dataset for params and time all stages on it"""
+    import decoders
+    import decoding_sets
+    import permutation
+    import preparation
+    import simple_example
+    from saa_data import SubjectData
+    from sklearn.model_selection import LeaveOneGroupOut
+
+    cfg_file = generate_bids(root, **params)
+    timer = Timer()
+    cfg = preparation.read_cfg_json(cfg_file)
+    files = preparation.find_subject_files(cfg['path'], cfg['substodo'])
+    timer('load', lambda: [preparation.read_session(path) for paths in files.values() for path in paths])
+    data = timer('preparation', preparation.prepare_data, cfg, 0)
+    data = {sub: SubjectData.from_dataframe(df) for sub, df in data.items()}
+    sets = decoding_sets.read_decoding_sets(cfg['decoding_sets_file'])
+
+    decoding, accuracies = {}, None
+    for decoder in decoders_to_run:
+        start = time.perf_counter()
+        accuracies = np.array([decoders.decode_subject(subject, sets, LeaveOneGroupOut(), decoder)[0]
+                               for subject in data.values()]).T
+        decoding[decoder] = time.perf_counter() - start
+    timer.times['decoding'] = decoding
+
+    parallel = {}
+    sessions = range(1, params['n_sessions'] + 1)
+    for n_jobs in n_jobs_list:
+        start = time.perf_counter()
+        simple_example.simple_process(os.path.dirname(cfg['path']), list(files), sessions,
+                                      LeaveOneGroupOut(), n_jobs=n_jobs, seed=0, decoder=decoders_to_run[-1],
+                                      plot_cv=False)
+        parallel[str(n_jobs)] = time.perf_counter() - start
+    timer.times['parallel_simple_process'] = parallel
+
+    statistics = {}
+    start = time.perf_counter()
+    permutation.sign_flip_test(accuracies)
+    statistics['sign_flip'] = time.perf_counter() - start
+    if n_permutations:
+        subject = next(iter(data.values()))
+        features, masks = decoding_sets.set_masks(subject.variables, sets)
+        start = time.perf_counter()
+        permutation.permutation_null(decoders.scale_min0max1(subject.matrix(features)), masks, subject.labels,
+                                     subject.sess_ind, LeaveOneGroupOut(), n_permutations)
+        statistics['permutations_per_subject'] = time.perf_counter() - start
+    timer.times['statistics'] = statistics
+
+    if plot:
+        try:
+            import pandas as pd
+            import visualization
+        except ImportError as error:
+            timer.times['plotting'] = None
+            print("Plotting not timed: {0}".format(error))
+        else:
+            set_names = [decoding_sets.set_name(s) for s in sets]
+            columns = ['sub-{0:02d}'.format(sub) for sub in data]
+            df = pd.DataFrame(accuracies, index=set_names, columns=columns)
+            timer('plotting', visualization.Visualization, accuracies, df, None,
+                  os.path.join(root, 'output', 'result.html'), columns=columns, sets=set_names, show=False)
+    return timer.times
+
+
+def check_decoders(params, root, tolerance=DECODER_TOLERANCE):
+    """
+    Cross-check of the decoder backends on a generated dataset, fold by fold:
+      - svc against cross_val_score with SVC(kernel='linear'), all decoding sets
+      - ncm against cross_val_score with NearestCentroid, all decoding sets
+      - lda against cross_val_score with LinearDiscriminantAnalysis, sets of one
+        variable (for several variables lda is the diagonal version)
+      - lda and ncm against svc: mean accuracy of each set over the subjects
+    Returns:
+            dict comparison -> largest difference of accuracy, and passed: the
+            first three are equal (1e-9) and the last ones within tolerance
+    """
+    import decoders
+    import decoding_sets
+    import preparation
+    from saa_data import SubjectData
+    from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+    from sklearn.model_selection import LeaveOneGroupOut, cross_val_score
+    from sklearn.neighbors import NearestCentroid
+    from sklearn.svm import SVC
+
+    cfg = preparation.read_cfg_json(generate_bids(root, **params))
+    sets = decoding_sets.read_decoding_sets(cfg['decoding_sets_file'])
+    references = dict(svc=SVC(kernel='linear'), ncm=NearestCentroid(), lda=LinearDiscriminantAnalysis())
+    differences = {'{0}_vs_sklearn'.format(name): 0. for name in references}
+    means = {name: [] for name in references}
+    for df in preparation.prepare_data(cfg, 0).values():
+        subject = SubjectData.from_dataframe(df)
+        features, masks = decoding_sets.set_masks(subject.variables, sets)
+        data = decoders.scale_min0max1(subject.matrix(features))
+        labels, groups, cv = subject.labels, subject.sess_ind, LeaveOneGroupOut()
+        for name, estimator in references.items():
+            folds = decoders.get_decoder(name)(data, masks, labels, groups, cv)
+            means[name].append(folds.mean(axis=0))
+            for set_ind, mask in enumerate(masks.T):
+                if name == 'lda' and mask.sum() > 1:
+                    continue
+                expected = cross_val_score(estimator, data[:, mask], labels, groups=groups, cv=cv)
+                key = '{0}_vs_sklearn'.format(name)
+                differences[key] = max(differences[key], float(np.abs(folds[:, set_ind] - expected).max()))
+    for name in ('lda', 'ncm'):
+        differences['{0}_vs_svc'.format(name)] = float(np.abs(np.mean(means[name], axis=0)
+                                                              - np.mean(means['svc'], axis=0)).max())
+    differences['passed'] = (all(differences['{0}_vs_sklearn'.format(name)] < 1e-9 for name in references) and
+                             all(differences['{0}_vs_svc'.format(name)] <= tolerance for name in ('lda', 'ncm')))
+    return differences
+
+
+def startup(repeat=5):
+    """
+    Startup cost of the command line interface.
+    Returns:
+            dict with the best wall time of `pySAA.py --help` in seconds and the
+            heavy modules that importing pySAA loads (should be empty)
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(here, 'pySAA.py'), '--help'], check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    code = 'import json, sys; import pySAA; print(json.dumps(sorted(set(m.split(".")[0] for m in sys.modules))))'
+    loaded = json.loads(subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                                       stdout=subprocess.PIPE, universal_newlines=True).stdout)
+    return dict(help_s=min(times), heavy_modules=[m for m in HEAVY_MODULES if m in loaded])
+
+
+def environment():
+    """Versions of python and the main dependencies"""
+    versions = dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count())
+    for module in ('numpy', 'pandas', 'sklearn', 'scipy', 'bokeh'):
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return versions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the stages of the python path of SAA on synthetic data")
+    parser.add_argument("--subjects", type=int, nargs='+', default=[4])
+    parser.add_argument("--sessions", type=int, nargs='+', default=[3])
+    parser.add_argument("--trials", type=int, nargs='+', default=[40], help="Trials per session")
+    parser.add_argument("--variables", type=int, nargs='+', default=[10])
+    parser.add_argument("--sets", type=int, nargs='+', default=[10], help="Number of decoding sets")
+    parser.add_argument("--decoders", nargs='+', default=['svc', 'lda', 'ncm'])
+    parser.add_argument("--n_jobs", type=int, nargs='+', default=[1], help="Process pool sizes for simple_process")
+    parser.add_argument("--n_permutations", type=int, default=1000, help="Permutations timed for one subject (0: skip)")
+    parser.add_argument("--no_plot", help="Do not time the plotting", action="store_true")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--check_startup", type=float, nargs='?', const=STARTUP_BUDGET, metavar="SECONDS",
+                        help="Only check that `pySAA.py --help` takes less than SECONDS (default: {0}) and that "
+                             "importing pySAA loads none of {1}. Exits with status 1 otherwise.".format(
+                                 STARTUP_BUDGET, ', '.join(HEAVY_MODULES)))
+    parser.add_argument("--check_decoders", type=float, nargs='?', const=DECODER_TOLERANCE, metavar="TOLERANCE",
+                        help="Only cross-check the decoder backends with scikit-learn and with each other on a dataset "
+                             "of the first sizes given (batched against svc within TOLERANCE, default: {0}). "
+                             "Exits with status 1 if they disagree.".format(DECODER_TOLERANCE))
+    args = parser.parse_args()
+
+    if args.check_startup is not None:
+        cost = startup()
+        print(json.dumps(cost))
+        if cost['help_s'] > args.check_startup or cost['heavy_modules']:
+            print("Startup over budget ({0} s) or heavy modules loaded".format(args.check_startup))
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.check_decoders is not None:
+        params = dict(n_subjects=args.subjects[0], n_sessions=args.sessions[0], n_trials=args.trials[0],
+                      n_variables=args.variables[0], n_sets=args.sets[0])
+        root = tempfile.mkdtemp(prefix='saa_check_')
+        try:
+            differences = check_decoders(params, root, args.check_decoders)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        print(json.dumps(differences))
+        sys.exit(0 if differences['passed'] else 1)
+
+    results = dict(environment=environment(), startup=startup(), cases=[])
+    grid = itertools.product(args.subjects, args.sessions, args.trials, args.variables, args.sets)
+    for n_subjects, n_sessions, n_trials, n_variables, n_sets in grid:
+        params = dict(n_subjects=n_subjects, n_sessions=n_sessions, n_trials=n_trials,
+                      n_variables=n_variables, n_sets=n_sets)
+        root = tempfile.mkdtemp(prefix='saa_bench_')
+        try:
+            times = run_case(params, args.decoders, args.n_jobs, args.n_permutations, not args.no_plot, root)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        print(json.dumps(dict(params=params, times=times)))
+        results['cases'].append(dict(params=params, times=times))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
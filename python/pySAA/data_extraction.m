@@ -21,13 +21,15 @@ function [all_data, regressor_names] = data_extraction(Sess, decoding_sets)
 SAAvariables = variable_extraction(Sess);
 
 % expand each decoding set
-expanded_subfields = cell(length(decoding_sets), 1);
+% the regexp matches are shared by all sets (each pattern is matched once)
+regexp_matches = containers.Map('KeyType', 'char', 'ValueType', 'any');
+set_subfields = cell(length(decoding_sets), 1);
 for set_ind = 1:length(decoding_sets)
-    expanded_subfields{set_ind} = expand_measure_fields(SAAvariables, decoding_sets{set_ind});
+    [set_subfields{set_ind}, regexp_matches] = expand_measure_fields(SAAvariables, decoding_sets{set_ind}, regexp_matches);
 end
 
 % get unique values
-expanded_subfields = unique([expanded_subfields{:}]);
+expanded_subfields = unique([set_subfields{:}]);
 
 % get data for all unique fields
 disp('Collecting data for all sessions & conditions for all unique fields')
@@ -35,7 +37,7 @@ disp('Collecting data for all sessions & conditions for all unique fields')
 
 % Generate masks
 disp('Creating one mask for each decoding_measure_set')
-all_data = create_mask(all_data, decoding_sets, col_condition_only);
+all_data = create_mask(all_data, decoding_sets, set_subfields, col_condition_only);
 
 end
 
@@ -56,7 +58,9 @@ for sess_ind=1:length(Sess)
 end
 end % end of function
 %% subfunction: Expand decoding_measure_set
-function expanded_subfields = expand_measure_fields(SAAvariables, decoding_measures)
+function [expanded_subfields, regexp_matches] = expand_measure_fields(SAAvariables, decoding_measures, regexp_matches)
+% regexp_matches: containers.Map pattern -> matched SAAvariables, filled
+% here, so that each pattern is matched only once for all decoding sets
 
 expanded_subfields = {};
 if ischar(decoding_measures)
@@ -72,18 +76,20 @@ for decoding_measure_ind = 1:length(decoding_measures)
    if length(curr_measure) > length('regexp:') && strcmp(curr_measure(1:length('regexp:')), 'regexp:')
        % get all subfields for the current expression
         regexppattern = curr_measure(length('regexp:')+1:end);
-        occurrence = regexp(SAAvariables, regexppattern, 'once');
-        subf_ind = find(~cellfun(@isempty, occurrence));
-        if isempty(subf_ind)
+        if ~isKey(regexp_matches, regexppattern)
+            occurrence = regexp(SAAvariables, regexppattern, 'once');
+            regexp_matches(regexppattern) = SAAvariables(~cellfun(@isempty, occurrence));
+        end
+        new_subfields = regexp_matches(regexppattern);
+        if isempty(new_subfields)
             warning('collect_data:subfield_not_found', 'No subfield matched %s', curr_measure);
         else
-            new_subfields = SAAvariables(subf_ind);
             display(sprintf('  Decoding_measure %s expanded to [ %s]', curr_measure, sprintf('%s ', new_subfields{:})))
             expanded_subfields = [expanded_subfields new_subfields];
         end
    else
         % check that the field indeed exists
-        if any(strcmp(curr_measure, SAAvariables))
+        if ismember(curr_measure, SAAvariables)
             display(sprintf('  Decoding_measure %s', curr_measure))
             expanded_subfields{end+1} = curr_measure;
         else
@@ -107,11 +113,15 @@ for sess_ind = 1:length(Sess)
         values = [];
         curr_col_names = {}; % init name for each dimension
 
+        % index of all subfields in U.SAAdata, looked up once instead of
+        % searching all variables for each subfield
+        data_points = {U.SAAdata.data_points};
+        [~, subfield_pos] = ismember(expanded_subfields, [U.SAAdata.variable]);
+
         % go through the evaluated subfields (these should exist now)
         for exp_subfield_ind = 1:length(expanded_subfields)
             curr_subfield = expanded_subfields{exp_subfield_ind};
-            data_points = {U.SAAdata.data_points};
-            curr_values = data_points{strcmp([U.SAAdata.variable], curr_subfield)};
+            curr_values = data_points{subfield_pos(exp_subfield_ind)};
             
             % check dimensionality, should be 1 or 2
             if length(size(curr_values)) > 2
@@ -198,7 +208,7 @@ all_data.hdr = ''; % we don't need a header, because we don't write img-files as
 all_data.mask_index = 1:size(all_data.data, 2); % use all voxels. These are NOT the ROI masks, only the indices of the voxels in the brain (which makes not much sense here)
 end % end of function
 %% subfunction to create masks
-function all_data = create_mask(all_data, decoding_measure_sets, col_condition_only)
+function all_data = create_mask(all_data, decoding_measure_sets, set_subfields, col_condition_only)
 
 for set_ind = 1:length(decoding_measure_sets)
     curr_set = decoding_measure_sets{set_ind};
@@ -206,32 +216,16 @@ for set_ind = 1:length(decoding_measure_sets)
     
     %all_data.files.mask{decoding_measure_set_ind, 1} = sprintf('%s, ', curr_set{:});
     all_data.files.mask{set_ind, 1} = strjoin(curr_set, ',');
-    all_data.masks.mask_data{set_ind, 1} = get_mask(curr_set, col_condition_only);
+    all_data.masks.mask_data{set_ind, 1} = get_mask(curr_set, set_subfields{set_ind}, col_condition_only);
 end
 end % end of function
 %%
-function mask_ind = get_mask(decoding_measures, col_condition_only)
+function mask_ind = get_mask(decoding_measures, subfields, col_condition_only)
+% subfields: the expanded subfields of decoding_measures, the columns of
+% these subfields are selected
 
-% init: empty mask
-mask_ind = false(1, length(col_condition_only));
 if ischar(decoding_measures), decoding_measures = {decoding_measures}; end
-
-for decoding_measure_ind = 1:length(decoding_measures)
-    curr_measure = decoding_measures{decoding_measure_ind};
-    % check if curr_measure starts with regexp:
-    if length(curr_measure) > length('regexp:') && strcmp(curr_measure(1:length('regexp:')), 'regexp:')
-        % get all subfields for the current expression
-        regexppattern = curr_measure(length('regexp:')+1:end);
-        subf_ind = ~cellfun(@isempty, regexp(col_condition_only, regexppattern, 'once'));
-    else
-        % check that the field indeed exists
-        subf_ind = strcmp(curr_measure, col_condition_only);
-    end
-    if ~any(subf_ind)
-        warning('get_mask:decoding_measure_not_found', 'Could not find any entry for %s', curr_measure);
-    end
-    mask_ind = mask_ind | subf_ind;
-end
+mask_ind = ismember(col_condition_only, subfields);
 
 if ~any(mask_ind)
     error('No single entry selected in mask for measures %s, please check (All expanded fields: %s)', sprintf('%s ', decoding_measures{:}),  sprintf('%s ', col_condition_only{:}))
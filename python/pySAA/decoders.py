@@ -0,0 +1,323 @@
+"""
+ Decoder backends for the python path of SAA.
+ Every backend decodes a set of features (columns) of a subject for each
+ column of a boolean mask matrix and returns the cross-validated accuracy
+ of every decoding set in every fold. Decoding each variable on its own is the identity mask.
+ 'svc' is the reference backend (one libsvm fit per decoding set and fold),
+ 'lda' and 'ncm' score all decoding sets in all folds with batched numpy operations.
+"""
+# coding: utf-8
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+import decoding_sets as dsets
+import instrumentation
+from saa_data import SubjectData
+
+
+def fold_masks(cv, n_samples, labels, groups):
+    """
+    Boolean train and test masks of every fold of cv.
+    Returns:
+            train, test: numpy arrays of shape n_folds x n_samples
+    """
+    X = np.zeros((n_samples, 1))
+    splits = list(cv.split(X, labels, groups))
+    train = np.zeros((len(splits), n_samples), dtype=bool)
+    test = np.zeros((len(splits), n_samples), dtype=bool)
+    for fold, (tr, tt) in enumerate(splits):
+        train[fold, tr] = True
+        test[fold, tt] = True
+    return train, test
+
+
+class Folds:
+    def __init__(self, cv, labels, groups):
+        """
+        Cross validation design of a subject, computed once and shared by all decoding
+        sets, the backends and the permutations. Every backend accepts a Folds in
+        place of the scikit-learn cv object.
+        Input:  cv: scikit-learn cross validation object
+                labels: condition of each sample
+                groups: cross validation group (session) of each sample
+        """
+        self.classes, self.y = np.unique(np.asarray(labels), return_inverse=True)
+        self.train, self.test = fold_masks(cv, len(self.y), labels, groups)
+        self.train_index = [np.flatnonzero(train) for train in self.train]
+        self.test_index = [np.flatnonzero(test) for test in self.test]
+
+    def __len__(self):
+        return len(self.train)
+
+    def design(self):
+        """Cross validation design of the batched backends, see design()"""
+        if np.any(self.test.sum(axis=0) > 1):
+            raise ValueError('Batched decoders need folds whose test sets do not overlap')
+        return self.y, len(self.classes), self.train, np.argmax(self.test, axis=0), self.test.any(axis=0)
+
+    def min0max1(self, data):
+        """
+        Scaling statistics of the training samples of every fold (cfg.scale.estimation = 'across').
+        Returns:
+                low, span: numpy arrays n_folds x n_features, scaled data is (data - low) / span
+        """
+        data = np.asarray(data, dtype=float)
+        low = np.array([np.nanmin(data[train], axis=0) for train in self.train_index])
+        high = np.array([np.nanmax(data[train], axis=0) for train in self.train_index])
+        return low, np.where(high > low, high - low, 1.)
+
+
+def as_folds(cv, labels, groups):
+    """cv if it is already a Folds, otherwise the Folds of cv"""
+    return cv if isinstance(cv, Folds) else Folds(cv, labels, groups)
+
+
+def scale_min0max1(data):
+    """Scale every feature to [0, 1] (cfg.scale.method = 'min0max1', estimation 'all')"""
+    data = np.asarray(data, dtype=float)
+    low, high = np.nanmin(data, axis=0), np.nanmax(data, axis=0)
+    span = np.where(high > low, high - low, 1.)
+    return (data - low) / span
+
+
+def decode_svc(data, masks, labels, groups, cv, n_jobs=1, scaling=None, set_names=None):
+    """
+    Reference backend: a linear SVC fitted for every decoding set in every fold.
+    The training and test matrices of each fold are extracted once and every set
+    selects its columns from them.
+    Input:  data: numpy array of shape n_samples x n_features
+            masks: boolean numpy array of shape n_features x n_sets
+            labels: condition of each sample
+            groups: cross validation group (session) of each sample
+            cv: scikit-learn cross validation object, or Folds
+            n_jobs: number of threads the folds are fitted in (-1: all cores)
+            scaling: low, span of Folds.min0max1 to scale each fold by its training data
+            set_names: names of the decoding sets for the spans of the trace, 'set <position>' if None
+    Returns:
+            numpy array n_folds x n_sets with the accuracy of each decoding set in each fold
+    """
+    # scikit-learn is only loaded by the reference backend
+    from sklearn import svm
+    folds = as_folds(cv, labels, groups)
+    data = np.asarray(data, dtype=float)
+    fold_data = []
+    for fold, (train, test) in enumerate(zip(folds.train_index, folds.test_index)):
+        scaled = data if scaling is None else (data - scaling[0][fold]) / scaling[1][fold]
+        fold_data.append((scaled[train], folds.y[train], scaled[test], folds.y[test]))
+
+    def fit_fold(mask, fold):
+        X_train, y_train, X_test, y_test = fold_data[fold]
+        clf = svm.SVC(kernel='linear', C=1)
+        return clf.fit(X_train[:, mask], y_train).score(X_test[:, mask], y_test)
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    # libsvm releases the GIL while fitting, so the folds run in threads
+    executor = ThreadPoolExecutor(n_jobs) if n_jobs > 1 else None
+    accuracies = np.empty((len(folds), masks.shape[1]))
+    if set_names is None:
+        set_names = ['set {0}'.format(set_ind) for set_ind in range(masks.shape[1])]
+    try:
+        for set_ind, mask in enumerate(masks.T):
+            with instrumentation.stage(set_names[set_ind], 'set', n_features=int(mask.sum())):
+                if executor is None:
+                    accuracies[:, set_ind] = [fit_fold(mask, fold) for fold in range(len(folds))]
+                else:
+                    accuracies[:, set_ind] = list(executor.map(lambda fold: fit_fold(mask, fold), range(len(folds))))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return accuracies
+
+
+def design(labels, groups, cv):
+    """
+    Cross validation design shared by the batched backends.
+    Input:  cv: scikit-learn cross validation object, or Folds
+    Returns:
+            y: class index of each sample
+            n_classes: number of classes
+            train: boolean n_folds x n_samples training mask of each fold
+            sample_fold: index of the fold in which each sample is tested
+            tested: boolean mask of the samples that are in some test set
+    """
+    return as_folds(cv, labels, groups).design()
+
+
+def _class_stats(data, y, n_classes, train):
+    """
+    Class means and pooled variances of the training set of every fold, for all
+    features at once. y may have leading dimensions (e.g. permutations x n_samples),
+    which are kept in front of the outputs.
+    Returns:
+            means: ... x n_folds x n_classes x n_features
+            var: ... x n_folds x n_features, pooled within class variance
+            counts: ... x n_folds x n_classes, training samples of each class
+    """
+    onehot = np.eye(n_classes)[y]                               # ... x n_samples x n_classes
+    weights = train[:, :, None] * onehot[..., None, :, :]       # ... x n_folds x n_samples x n_classes
+    counts = weights.sum(axis=-2)
+    sums = np.einsum('...fnc,nv->...fcv', weights, data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts[..., None]
+        sq_sums = np.einsum('...fnc,nv->...fcv', weights, data ** 2)
+        var = np.nansum(sq_sums - counts[..., None] * means ** 2, axis=-2) / train.sum(axis=1)[:, None]
+    # classes without training samples are excluded when predicting
+    return np.nan_to_num(means), var, counts
+
+
+def _set_accuracy(score, y, sample_fold, counts, tested):
+    """
+    Accuracy of each decoding set in each fold, ... x n_folds x n_sets.
+    score: ... x n_samples x n_classes x n_sets, the class with the highest score is predicted
+    """
+    absent = counts[..., sample_fold, :] == 0                   # ... x n_samples x n_classes
+    score = np.where(absent[..., None], -np.inf, score)
+    correct = np.argmax(score, axis=-2) == y[..., None]         # ... x n_samples x n_sets
+    fold_onehot = np.eye(counts.shape[-2])[sample_fold[tested]] # n_tested x n_folds
+    return fold_onehot.T @ correct[..., tested, :] / fold_onehot.sum(axis=0)[:, None]
+
+
+def ncm_accuracy(data, masks, y, n_classes, train, sample_fold, tested):
+    """Fold accuracies of the nearest class mean rule for the design returned by design()"""
+    means, _, counts = _class_stats(data, y, n_classes, train)
+    # squared distance of each sample to the class means of the fold it is tested in,
+    # per feature, then summed over the features of each set
+    sq_dist = (data[:, None, :] - means[..., sample_fold, :, :]) ** 2   # ... x n_samples x n_classes x n_features
+    return _set_accuracy(-(sq_dist @ masks), y, sample_fold, counts, tested)
+
+
+def lda_accuracy(data, masks, y, n_classes, train, sample_fold, tested):
+    """Fold accuracies of the diagonal LDA for the design returned by design()"""
+    means, var, counts = _class_stats(data, y, n_classes, train)
+    # without variance within the classes the discriminant degenerates to the
+    # nearest class mean, which a tiny variance reproduces
+    var = np.maximum(np.nan_to_num(var), 1e-10 * (1 + np.nanmax(var)))
+    mu = means[..., sample_fold, :, :]                          # ... x n_samples x n_classes x n_features
+    contribution = (data[:, None, :] * mu - 0.5 * mu ** 2) / var[..., sample_fold, None, :]
+    with np.errstate(divide='ignore'):
+        log_prior = np.log(counts / counts.sum(axis=-1, keepdims=True))[..., sample_fold, :, None]
+    return _set_accuracy(contribution @ masks + log_prior, y, sample_fold, counts, tested)
+
+
+def decode_ncm(data, masks, labels, groups, cv, n_jobs=1):
+    """
+    Nearest class mean classifier (euclidean distance), all decoding sets and
+    folds in one array computation. Same input and output as decode_svc,
+    n_jobs is ignored.
+    """
+    return ncm_accuracy(np.asarray(data, dtype=float), masks, *design(labels, groups, cv))
+
+
+def decode_lda(data, masks, labels, groups, cv, n_jobs=1):
+    """
+    Linear discriminant analysis with a diagonal covariance (shared between
+    classes), all decoding sets and folds in one array computation.
+    Same input and output as decode_svc, n_jobs is ignored.
+    """
+    return lda_accuracy(np.asarray(data, dtype=float), masks, *design(labels, groups, cv))
+
+
+DECODERS = {
+    'svc': decode_svc,
+    'lda': decode_lda,
+    'ncm': decode_ncm,
+}
+
+# backends that accept labels with leading dimensions (e.g. permutations)
+BATCHED = {
+    'lda': lda_accuracy,
+    'ncm': ncm_accuracy,
+}
+
+
+def decode_subject(subject, decoding_sets, cv, decoder='svc', labelnames=None, return_folds=False,
+                   n_permutations=0, rng=None, n_jobs=1, scale='all', cache=None):
+    """
+    Decode the decoding sets of a prepared subject.
+    The variables of all sets are extracted and scaled once, each set is a mask
+    of the columns of this single feature matrix.
+    Input:  subject: saa_data.SubjectData, or a subject DataFrame (see preparation.py)
+            decoding_sets: list of decoding sets (see decoding_sets.read_decoding_sets),
+                           None decodes every variable on its own
+            cv: scikit-learn cross validation object, the sessions are the groups
+            decoder: name of the backend in DECODERS
+            labelnames: conditions to decode, all of them if None
+            return_folds: also return the accuracy minus chance in each fold
+            n_permutations: also return the accuracy minus chance of this many label
+                            permutations (see permutation.permutation_null), the null is
+                            built with the decoder itself, so it must be a batched one
+            rng: numpy random generator for the permutations
+            n_jobs: number of threads for the folds of the svc backend
+            scale: estimation of the min0max1 scaling, 'all' samples of the subject or the
+                   training samples of each fold ('across', svc backend only)
+            cache: result_cache.ResultCache, only the sets that are not in it are decoded
+    Returns:
+            accuracy minus chance of each decoding set (mean over folds), names of the decoding sets
+            [, accuracy minus chance n_folds x n_sets] [, accuracy minus chance n_permutations x n_sets]
+    """
+    if n_permutations and decoder not in BATCHED:
+        raise ValueError('Permutations need a batched decoder: {0}'.format(', '.join(BATCHED)))
+    if not isinstance(subject, SubjectData):
+        subject = SubjectData.from_dataframe(subject)
+    if labelnames:
+        subject = subject.select_conditions(labelnames)
+    if decoding_sets is None:
+        decoding_sets = [[var] for var in subject.variables]
+    features, masks = dsets.set_masks(subject.variables, decoding_sets)
+    labels, groups = subject.labels, subject.sess_ind
+    # the folds are split once for all sets, backends and permutations
+    folds = as_folds(cv, labels, groups)
+    chance_level = 1.0 / len(folds.classes)
+    if scale == 'across':
+        if decoder != 'svc':
+            raise ValueError("Scaling with estimation 'across' needs the svc decoder")
+        data = subject.matrix(features)
+        scaling = folds.min0max1(data)
+    elif scale == 'all':
+        data = scale_min0max1(subject.matrix(features))
+        scaling = None
+    else:
+        raise ValueError("Unknown scale estimation {0}, choose 'all' or 'across'".format(scale))
+    fold_accuracies = np.empty((len(folds), masks.shape[1]))
+    todo = list(range(masks.shape[1]))
+    if cache is not None:
+        keys = cache.keys(subject, features, masks, dict(decoder=decoder, cv=repr(cv), scale=scale))
+        cached = cache.get(keys)
+        todo = [set_ind for set_ind, key in enumerate(keys) if key not in cached]
+        for set_ind, key in enumerate(keys):
+            if key in cached:
+                fold_accuracies[:, set_ind] = cached[key]
+    if todo:
+        # the scaling is per feature, so the sets still to decode can use the columns they need
+        used = masks[:, todo].any(axis=1)
+        kwargs = {} if scaling is None else dict(scaling=(scaling[0][:, used], scaling[1][:, used]))
+        if decoder == 'svc':
+            # the spans are named after the sets, not their position among those still to decode
+            kwargs['set_names'] = [dsets.set_name(decoding_sets[set_ind]) for set_ind in todo]
+        # the batched backends decode all sets at once, svc records a span per set
+        with instrumentation.stage('decode', 'decoding', decoder=decoder, n_sets=len(todo)):
+            fold_accuracies[:, todo] = get_decoder(decoder)(data[:, used], masks[used][:, todo], labels, groups,
+                                                            folds, n_jobs, **kwargs)
+        if cache is not None:
+            cache.put({keys[set_ind]: fold_accuracies[:, set_ind] for set_ind in todo})
+    fold_accuracies -= chance_level
+    result = (fold_accuracies.mean(axis=0), [dsets.set_name(s) for s in decoding_sets])
+    if return_folds:
+        result += (fold_accuracies,)
+    if n_permutations:
+        import permutation
+        with instrumentation.stage('permutations', 'decoding', decoder=decoder, n_permutations=n_permutations):
+            null = permutation.permutation_null(data, masks, labels, groups, folds, n_permutations, decoder, rng)
+        result += (null - chance_level,)
+    return result
+
+
+def get_decoder(name):
+    """Return the decoding function registered under name"""
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError('Unknown decoder {0}, choose one of: {1}'.format(name, ', '.join(DECODERS)))
@@ -0,0 +1,125 @@
+"""
+ Decoding sets for the python path of SAA (read_decoding_sets.m and the
+ expansion and masks of data_extraction.m).
+ The variables of all decoding sets are expanded and collected once, and each
+ decoding set becomes a column mask of that single feature matrix.
+ Names are looked up in a dict of the variables and each regular expression
+ is compiled and matched once per list of variables, so the expansion stays
+ linear in the number of variables for wide datasets.
+"""
+# coding: utf-8
+
+from functools import lru_cache
+import re
+import warnings
+
+import numpy as np
+
+REGEXP = 'regexp:'
+
+
+def read_decoding_sets(decoding_sets_file):
+    """
+    Read the tsv file with one decoding set per row. Each cell holds the name of
+    a variable or a regular expression (regexp:<pattern>) matching variables.
+    Returns:
+            list of decoding sets, e.g. [['name', 'trialnr'], ['regexp:^r'], ['accuracy']]
+    """
+    decoding_sets = []
+    with open(decoding_sets_file, encoding='ISO-8859-1') as f:
+        for line in f:
+            # separate by tabs and remove empty values
+            decoding_set = [entry for entry in line.rstrip('\r\n').split('\t') if entry]
+            if decoding_set:
+                decoding_sets.append(decoding_set)
+    return decoding_sets
+
+
+def set_name(decoding_set):
+    """String describing a decoding set, as in the rows of the output tsv"""
+    return ' '.join(decoding_set)
+
+
+@lru_cache(maxsize=None)
+def _compile(pattern):
+    """Compiled regular expression, each pattern is compiled once per process"""
+    return re.compile(pattern)
+
+
+class VariableIndex:
+    def __init__(self, variables):
+        """
+        Index of the SAA variables of a subject: position of each name and the
+        matches of each regular expression, computed once and then looked up.
+        Input:  variables: names of the SAA variables
+        """
+        self.variables = tuple(variables)
+        self.position = {}
+        for ind, var in enumerate(self.variables):
+            self.position.setdefault(var, ind)
+        self._matches = {}
+
+    def __contains__(self, var):
+        return var in self.position
+
+    def match(self, pattern):
+        """Variables matched by a regular expression (searched once per pattern)"""
+        if pattern not in self._matches:
+            search = _compile(pattern).search
+            self._matches[pattern] = [var for var in self.variables if search(var)]
+        return self._matches[pattern]
+
+
+@lru_cache(maxsize=16)
+def variable_index(variables):
+    """VariableIndex of a tuple of variable names, shared by the subjects with the same variables"""
+    return VariableIndex(variables)
+
+
+def expand_measure_fields(variables, decoding_set):
+    """
+    Expand the measures of a decoding set into the variables they refer to:
+    names are kept if the variable exists, regular expressions are replaced
+    by all the variables they match.
+    Input:  variables: names of the SAA variables or their VariableIndex
+            decoding_set: list of names and regexp:<pattern> entries
+    """
+    if not isinstance(variables, VariableIndex):
+        variables = variable_index(tuple(variables))
+    expanded = []
+    for measure in decoding_set:
+        if len(measure) > len(REGEXP) and measure.startswith(REGEXP):
+            matches = variables.match(measure[len(REGEXP):])
+            if not matches:
+                warnings.warn('No subfield matched {0}'.format(measure))
+            expanded.extend(matches)
+        elif measure in variables:
+            expanded.append(measure)
+        else:
+            warnings.warn('Could not find subfield {0}'.format(measure))
+    if not expanded:
+        warnings.warn('No subfields found for {0}, please check'.format(set_name(decoding_set)))
+    return expanded
+
+
+def set_masks(variables, decoding_sets):
+    """
+    Collect the variables of all decoding sets once and create the mask of each set.
+    Input:  variables: names of the available SAA variables
+            decoding_sets: list of decoding sets (see read_decoding_sets)
+    Returns:
+            features: unique variables used by any decoding set
+            masks: boolean numpy array of shape n_features x n_sets
+    """
+    index = variable_index(tuple(variables))
+    expanded = [expand_measure_fields(index, decoding_set) for decoding_set in decoding_sets]
+    # unique fields, in order of appearance
+    features = list(dict.fromkeys(var for fields in expanded for var in fields))
+    column = {var: i for i, var in enumerate(features)}
+    masks = np.zeros((len(features), len(decoding_sets)), dtype=bool)
+    for set_ind, fields in enumerate(expanded):
+        if not fields:
+            raise ValueError('No single entry selected in mask for measures {0}, please check (All fields: {1})'
+                             .format(set_name(decoding_sets[set_ind]), ' '.join(index.variables)))
+        masks[[column[var] for var in fields], set_ind] = True
+    return features, masks
@@ -0,0 +1,184 @@
+"""
+ Out-of-core reading of the session tsv files of a subject.
+ For very long sessions (e.g. continuous recordings with millions of rows) the
+ files are not loaded, concatenated and sorted as DataFrames. Each session is
+ streamed in chunks of rows that are converted and written straight into
+ typed arrays, preallocated from the number of lines of the files:
+ integer or float for numeric variables, the rank of the value (as
+ preparation.to_numeric) for text variables. The rows are then grouped by
+ session and condition with a counting permutation instead of a sort, applied
+ one array at a time, so the peak memory of a subject is its final arrays plus
+ one chunk and one array.
+ The result is the same SubjectData as preparation.prepare_data followed by
+ SubjectData.from_dataframe.
+"""
+# coding: utf-8
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import preparation
+from saa_data import SubjectData
+
+DEFAULT_CHUNK_ROWS = 100000
+
+
+def count_lines(path):
+    """Number of lines of a file, read in blocks"""
+    lines, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # last line without a line break
+    return lines + (last != b'\n')
+
+
+def _session_chunks(path, previous_on=False, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Chunks of a session tsv file as DataFrames of strings, with the columns of
+    preparation.read_session (prev_ columns and 'indices') but in file order.
+    """
+    last, start = None, 1
+    with pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False, index_col=False,
+                     chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            if previous_on:
+                # add_previous across chunk boundaries: the first row gets the last one of the chunk before
+                previous = chunk.shift(1)
+                if last is not None:
+                    previous.iloc[0] = last
+                last = chunk.iloc[-1].to_numpy()
+                previous = previous.fillna('n/a')
+                previous.columns = ['prev_' + col for col in chunk]
+                chunk = pd.concat([chunk, previous], axis=1)
+            chunk['indices'] = np.arange(start, start + len(chunk.index))
+            start += len(chunk.index)
+            yield chunk
+
+
+def _read_columns(files, defaults, previous_on, chunk_rows, text):
+    """
+    Read the sessions into arrays in file order.
+    Input:  text: variables known not to be numeric
+    Returns:
+            names of the variables, OrderedDict name -> array, session of each row,
+            condition of each row, conditions and text (extended with the variables that
+            turned out not to be numeric after numeric chunks: the arrays are then incomplete)
+    """
+    # upper bound of the number of rows: one header line per file
+    n_rows = sum(count_lines(path) - 1 for path in files)
+    names, columns, levels, late_text = None, OrderedDict(), {}, set()
+    sess_ind = np.empty(n_rows, dtype=np.int32)
+    cond_ind = np.empty(n_rows, dtype=np.int32)
+    conditions = {}
+    row = 0
+    for sess, path in enumerate(files, 1):
+        for chunk in _session_chunks(path, previous_on, chunk_rows):
+            chunk = preparation.replace_defaults(chunk, defaults)
+            if names is None:
+                names = preparation.variables(chunk)
+                levels = {col: {} for col in names if col in text}
+            elif preparation.variables(chunk) != names:
+                raise ValueError('The columns of {0} differ from those of {1}'.format(path, files[0]))
+            stop = row + len(chunk.index)
+            sess_ind[row:stop] = sess
+            for condition in chunk['name'].unique():
+                conditions.setdefault(condition, len(conditions))
+            cond_ind[row:stop] = chunk['name'].map(conditions).to_numpy()
+            for col in names:
+                if col in late_text:
+                    continue
+                values = None
+                if col not in levels:
+                    try:
+                        values = pd.to_numeric(chunk[col]).to_numpy()
+                    except (ValueError, TypeError):
+                        if col in columns:
+                            # numeric in the chunks before
+                            late_text.add(col)
+                            continue
+                        levels[col] = {}
+                if values is None:
+                    # text values -> code in order of appearance, replaced by their rank at the end
+                    col_levels = levels[col]
+                    for value in chunk[col].unique():
+                        col_levels.setdefault(value, len(col_levels))
+                    values = chunk[col].map(col_levels).to_numpy()
+                if col not in columns:
+                    columns[col] = np.empty(n_rows, dtype=values.dtype)
+                elif np.result_type(columns[col].dtype, values.dtype) != columns[col].dtype:
+                    # e.g. integers in the first chunks and floats later
+                    columns[col] = columns[col].astype(np.result_type(columns[col].dtype, values.dtype))
+                columns[col][row:stop] = values
+            row = stop
+    if names is None:
+        raise ValueError('No trials found in {0}'.format(', '.join(files)))
+    for col, col_levels in levels.items():
+        # as preparation.to_numeric: rank (starting with 1) of the sorted values
+        rank = np.empty(len(col_levels), dtype=np.int64)
+        for i, value in enumerate(sorted(col_levels, key=str)):
+            rank[col_levels[value]] = i + 1
+        columns[col] = rank[columns[col][:row]]
+    columns = OrderedDict((col, columns[col][:row]) for col in names if col in columns)
+    return names, columns, sess_ind[:row], cond_ind[:row], list(conditions), text | late_text
+
+
+def _group_order(sess_ind, cond_ind, n_conditions):
+    """
+    Permutation that groups the rows (in session order) by condition inside each
+    session, keeping the order of the trials, by counting instead of sorting.
+    """
+    order = np.empty(len(sess_ind), dtype=np.int64)
+    bounds = np.flatnonzero(np.diff(sess_ind)) + 1
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(sess_ind)]):
+        session = cond_ind[start:stop]
+        position = start
+        for condition in range(n_conditions):
+            rows = np.flatnonzero(session == condition) + start
+            order[position:position + len(rows)] = rows
+            position += len(rows)
+    return order
+
+
+def read_subject(files, cfg, defaults, scales, rng=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Read, preprocess and apply the user functions to the sessions of one subject
+    (as preparation.prepare_subject), reading the files in chunks.
+    Input:  files: data files of the sessions
+            cfg: dictionary returned by preparation.read_cfg_json
+            defaults, scales: as returned by preparation.read_description
+            rng: random generator of the user functions
+            chunk_rows: number of rows read at a time
+    Returns:
+            SubjectData
+    """
+    previous_on = cfg.get('previous_on', False)
+    text = set()
+    while True:
+        names, columns, sess_ind, cond_ind, conditions, found = _read_columns(files, defaults, previous_on,
+                                                                              chunk_rows, text)
+        if found == text:
+            break
+        # a variable was not numeric after its first chunk: read again with it as text
+        del columns
+        text = found
+
+    # conditions in sorted order, as the sort by 'name' of preparation.read_session
+    rank = np.empty(len(conditions), dtype=np.int32)
+    rank[np.argsort(np.array(conditions, dtype=object))] = np.arange(len(conditions))
+    cond_ind = rank[cond_ind]
+    order = _group_order(sess_ind, cond_ind, len(conditions))
+    for col in names:
+        # one array at a time
+        columns[col] = columns[col][order]
+    columns.update(preparation.ordinal_columns(columns, scales))
+    functions = cfg.get('functions', [])
+    if functions:
+        # the user functions work on DataFrames, this one shares the arrays
+        df = preparation.apply_functions(pd.DataFrame(columns, copy=False), functions, rng)
+        columns = OrderedDict((col, df[col].to_numpy()) for col in df)
+    # the sessions keep their rows
+    return SubjectData(columns, sess_ind, cond_ind[order], sorted(conditions))
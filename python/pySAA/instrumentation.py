@@ -0,0 +1,201 @@
+"""
+ Timing instrumentation of SAA.
+ Stages (loading, preparation, decoding, ...), subjects and decoding sets are
+ recorded with their wall time, CPU time and the peak resident memory of the
+ process during the span (peak_rss_mb, on Linux: the high water mark VmHWM is
+ reset at the start and end of every span). Where it cannot be reset the
+ cumulative peak of the process since its start is recorded instead
+ (max_rss_so_far_mb). The records are written as a Chrome trace-event JSON
+ file, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+ Optionally the whole run is captured with cProfile or tracemalloc.
+
+ Modules record spans with the module level stage() context manager, which
+ does nothing unless a Tracer was activated:
+     with instrumentation.stage('decode', 'decoding', n_sets=10):
+         ...
+"""
+# coding: utf-8
+
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+# tracer that receives the spans of stage(), None if nothing is recorded
+_active = None
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory since the start of the process and of its finished children in MB
+    (cumulative, it never decreases), None if unknown
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on linux and in bytes on macOS
+    unit = 1. if sys.platform == 'darwin' else 1024.
+    peaks = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return round(max(peaks) * unit / 2 ** 20, 1)
+
+
+def _vm_hwm_kb():
+    """High water mark of the resident memory of the process in kB (linux), None if unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _reset_hwm():
+    """Reset the high water mark to the current resident memory, False if not possible"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class Tracer:
+    def __init__(self, profiler=None, verbose=True):
+        """
+        Recorder of timed spans.
+        Input:  profiler: None, 'cprofile' or 'tracemalloc', captured between start() and stop()
+                verbose: print the beginning and end of the spans of category 'stage'
+        """
+        if profiler not in (None,) + PROFILERS:
+            raise ValueError('Unknown profiler {0}, choose one of: {1}'.format(profiler, ', '.join(PROFILERS)))
+        self.profiler = profiler
+        self.verbose = verbose
+        self.events = []
+        self._origin = time.perf_counter()
+        self._profile = None
+        self._lock = threading.Lock()
+        # peak of each open span in kB, None if the peak of a span cannot be measured
+        self._open = {} if _vm_hwm_kb() is not None and _reset_hwm() else None
+
+    def start(self):
+        """Activate the tracer for stage() and start the profiler"""
+        global _active
+        _active = self
+        if self.profiler == 'cprofile':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == 'tracemalloc':
+            import tracemalloc
+            tracemalloc.start()
+        return self
+
+    def stop(self):
+        """Deactivate the tracer and stop the profiler"""
+        global _active
+        if _active is self:
+            _active = None
+        if self._profile is not None:
+            self._profile.disable()
+
+    def _update_peaks(self):
+        """Fold the high water mark into the peak of every open span and reset it (with the lock held)"""
+        hwm = _vm_hwm_kb()
+        for span in self._open:
+            self._open[span] = max(self._open[span], hwm)
+        _reset_hwm()
+
+    def _span_start(self):
+        if self._open is None:
+            return None
+        span = object()
+        with self._lock:
+            self._update_peaks()
+            self._open[span] = _vm_hwm_kb()
+        return span
+
+    def _span_peak_mb(self, span):
+        """Peak resident memory of the process during the span in MB"""
+        with self._lock:
+            self._update_peaks()
+            return round(self._open.pop(span) / 1024., 1)
+
+    @contextmanager
+    def stage(self, name, category='stage', **args):
+        """
+        Record the span of the with block.
+        Input:  name: shown in the trace
+                category: 'stage', 'subject', 'set', ...
+                args: extra values stored with the span
+        """
+        if self.verbose and category == 'stage':
+            print("Starting {0}".format(name))
+        span = self._span_start()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            args.update(wall_s=round(wall, 6), cpu_s=round(cpu, 6))
+            if span is None:
+                memory = 'max RSS so far'
+                args.update(max_rss_so_far_mb=peak_rss_mb())
+            else:
+                memory = 'peak RSS'
+                args.update(peak_rss_mb=self._span_peak_mb(span))
+            if self.profiler == 'tracemalloc':
+                import tracemalloc
+                if tracemalloc.is_tracing():
+                    current, peak = tracemalloc.get_traced_memory()
+                    args.update(traced_mb=round(current / 2 ** 20, 1), traced_peak_mb=round(peak / 2 ** 20, 1))
+            event = dict(name=name, cat=category, ph='X', ts=(start - self._origin) * 1e6, dur=wall * 1e6,
+                         pid=os.getpid(), tid=threading.get_ident(), args=args)
+            with self._lock:
+                self.events.append(event)
+            if self.verbose and category == 'stage':
+                print("Finished {0} in {1:.2f} s (CPU {2:.2f} s, {3} {4} MB)".format(
+                    name, wall, cpu, memory, args.get('peak_rss_mb', args.get('max_rss_so_far_mb'))))
+
+    def write(self, output_name):
+        """
+        Write <output_name>_trace.json (Chrome trace-event format) and the
+        profiler output: <output_name>_profile.prof (pstats) or <output_name>_tracemalloc.txt
+        Returns:
+                path of the trace file
+        """
+        trace_file = output_name + '_trace.json'
+        os.makedirs(os.path.dirname(trace_file) or '.', exist_ok=True)
+        with open(trace_file, 'w') as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms',
+                           otherData=dict(argv=sys.argv, profiler=self.profiler)), f)
+        if self._profile is not None:
+            self._profile.dump_stats(output_name + '_profile.prof')
+        elif self.profiler == 'tracemalloc':
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                stats = tracemalloc.take_snapshot().statistics('lineno')
+                with open(output_name + '_tracemalloc.txt', 'w') as f:
+                    f.write('\n'.join(str(stat) for stat in stats[:50]) + '\n')
+                tracemalloc.stop()
+        return trace_file
+
+
+@contextmanager
+def stage(name, category='stage', **args):
+    """Record the with block in the active tracer, if there is one"""
+    if _active is None:
+        yield
+    else:
+        with _active.stage(name, category, **args):
+            yield
@@ -0,0 +1,142 @@
+"""
+ Permutation tests for SAA.
+ First level: the labels of a subject are permuted within each session, so the
+ LeaveOneGroupOut fold structure is preserved, and all permutations are decoded
+ together with the batched backends of decoders.py.
+ Second level: sign-flip tests of the accuracies minus chance of all subjects,
+ or a group null built from the first level permutations. Both give empirical
+ null distributions and max-statistic family-wise corrected p-values for all
+ decoding sets at once.
+ All p-values are one-sided (accuracy above chance).
+"""
+# coding: utf-8
+
+import numpy as np
+
+import decoders
+
+# maximum number of elements of the largest array computed per batch of permutations
+BATCH_ELEMENTS = 2 ** 25
+
+
+def within_group_permutations(groups, n_permutations, rng):
+    """
+    Index arrays that shuffle the samples within each group.
+    Returns:
+            numpy array n_permutations x n_samples
+    """
+    groups = np.asarray(groups)
+    _, group_rank = np.unique(groups, return_inverse=True)
+    by_group = np.argsort(group_rank, kind='stable')
+    # random keys that keep the samples inside the block of their group
+    keys = group_rank[by_group][None, :] + rng.random((n_permutations, len(groups)))
+    permutations = np.empty((n_permutations, len(groups)), dtype=np.intp)
+    permutations[:, by_group] = by_group[np.argsort(keys, axis=1)]
+    return permutations
+
+
+def permutation_null(data, masks, labels, groups, cv, n_permutations=1000, decoder='lda', rng=None):
+    """
+    Accuracies of all decoding sets for labels permuted within sessions.
+    Input:  data, masks, labels, groups, cv: as for decoders.decode_svc
+            n_permutations: number of permutations
+            decoder: name of a batched backend (decoders.BATCHED)
+            rng: numpy random generator
+    Returns:
+            numpy array n_permutations x n_sets with the mean accuracy over folds
+    """
+    if decoder not in decoders.BATCHED:
+        raise ValueError('Permutations need a batched decoder: {0}'.format(', '.join(decoders.BATCHED)))
+    rng = np.random.default_rng() if rng is None else rng
+    accuracy = decoders.BATCHED[decoder]
+    data = np.asarray(data, dtype=float)
+    y, n_classes, train, sample_fold, tested = decoders.design(labels, groups, cv)
+    permutations = within_group_permutations(groups, n_permutations, rng)
+    # number of permutations that are decoded together, bounded by the largest array per
+    # permutation: the training weights (n_folds x n_samples x n_classes) of decoders._class_stats
+    # or the scores (n_samples x n_classes x features or sets) of the backends
+    n_folds = train.shape[0]
+    per_permutation = len(y) * n_classes * max(n_folds, data.shape[1], masks.shape[1])
+    batch = max(1, BATCH_ELEMENTS // per_permutation)
+    null = np.empty((n_permutations, masks.shape[1]))
+    for start in range(0, n_permutations, batch):
+        y_perm = y[permutations[start:start + batch]]           # batch x n_samples
+        folds = accuracy(data, masks, y_perm, n_classes, train, sample_fold, tested)
+        null[start:start + batch] = folds.mean(axis=-2)
+    return null
+
+
+def _p_values(statistic, null, exact=False):
+    """
+    Uncorrected and max-statistic corrected one-sided p-values.
+    Input:  statistic: n_sets, null: n_null x n_sets
+            exact: the null enumerates all permutations, the observed one included,
+                   otherwise they are random samples and the observed statistic is added
+    """
+    null = np.nan_to_num(null, nan=-np.inf)
+    offset = 0 if exact else 1
+    p_values = (offset + (null >= statistic).sum(axis=0)) / (offset + len(null))
+    max_null = null.max(axis=1)
+    p_fwe = (offset + (max_null[:, None] >= statistic).sum(axis=0)) / (offset + len(null))
+    return p_values, p_fwe
+
+
+def sign_flip_test(accuracies, n_flips=10000, statistic='t', rng=None):
+    """
+    Second level sign-flip permutation test of the accuracies minus chance.
+    Input:  accuracies: numpy array n_sets x n_subjects (accuracy minus chance)
+            n_flips: number of random sign flips (all of them if there are fewer)
+            statistic: 't' (one sample t) or 'mean'
+            rng: numpy random generator
+    Returns:
+            dict with statistic (n_sets), null (n_flips x n_sets), p_values and p_fwe (n_sets)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    accuracies = np.asarray(accuracies, dtype=float)
+    n_subs = accuracies.shape[1]
+    exact = 2 ** n_subs <= n_flips
+    if exact:
+        # exact test over all sign combinations, the first one keeps all signs
+        codes = np.arange(2 ** n_subs)[:, None] >> np.arange(n_subs) & 1
+        flips = 1 - 2 * codes
+    else:
+        # the observed signs are added as the first flip
+        flips = np.vstack([np.ones((1, n_subs), dtype=int), rng.choice((-1, 1), size=(n_flips, n_subs))])
+    # a sign flip changes the sum but not the sum of squares of each set,
+    # so the null is one matrix product
+    null = flips @ accuracies.T / n_subs
+    if statistic == 't':
+        # one sample t statistic: mean / sqrt((mean of squares - mean ** 2) / (n - 1))
+        sq_mean = (accuracies ** 2).mean(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            null /= np.sqrt(np.maximum(sq_mean - null ** 2, 0) / (n_subs - 1))
+    # computed as the null, so that the observed signs compare equal to themselves
+    observed = null[0]
+    if not exact:
+        null = null[1:]
+    # a set without variance (e.g. every subject exactly at chance) has no evidence
+    # above chance: its undefined t statistic gets p = 1
+    p_values, p_fwe = _p_values(np.nan_to_num(observed, nan=-np.inf), null, exact)
+    return dict(statistic=observed, null=null, p_values=p_values, p_fwe=p_fwe)
+
+
+def group_permutation_test(accuracies, subject_nulls, n_samples=10000, rng=None):
+    """
+    Second level test from first level permutations (Stelzer et al., 2013):
+    the group null distribution is the mean over subjects of one random
+    permutation result of each subject.
+    Input:  accuracies: numpy array n_sets x n_subjects
+            subject_nulls: list with the permutation_null of each subject (n_permutations x n_sets)
+            n_samples: number of samples of the group null distribution
+            rng: numpy random generator
+    Returns:
+            dict with statistic (n_sets), null (n_samples x n_sets), p_values and p_fwe (n_sets)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    observed = np.asarray(accuracies, dtype=float).mean(axis=1)
+    null = np.zeros((n_samples, len(observed)))
+    for subject_null in subject_nulls:
+        null += subject_null[rng.integers(len(subject_null), size=n_samples)]
+    null /= len(subject_nulls)
+    p_values, p_fwe = _p_values(observed, null)
+    return dict(statistic=observed, null=null, p_values=p_values, p_fwe=p_fwe)
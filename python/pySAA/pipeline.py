@@ -0,0 +1,98 @@
+"""
+ Overlapped reading, decoding and writing for the streaming mode of SAA.
+ While a subject is decoded, the next subjects are read and prepared by a
+ loader process (or thread), at most depth of them ahead, so only a few
+ subjects are in memory at a time, and the outputs of the finished subjects
+ are written by a writer thread.
+"""
+# coding: utf-8
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+
+
+def _result(future):
+    """Result of a future of _timed_load, errors of the executor (e.g. pickling) are returned as well"""
+    try:
+        return future.result()
+    except Exception as error:
+        return None, error, 0.
+
+
+def _timed_load(load, item):
+    """load(item) and its duration, errors are returned instead of raised"""
+    start = time.time()
+    try:
+        return load(item), None, time.time() - start
+    except Exception as error:
+        return None, error, time.time() - start
+
+
+def prefetch(items, load, depth=2, processes=False):
+    """
+    Load the items in the background, at most depth items ahead of the consumer.
+    Input:  items: list of items to load
+            load: function item -> loaded value (picklable if processes is True)
+            depth: number of items loaded ahead, 0 loads in the calling thread
+            processes: load in a separate process instead of a thread, for loading
+                       that is mostly python code and would hold the GIL
+    Yields:
+            item, loaded value (None if it failed), exception (None if it succeeded), seconds of loading
+            (loading errors, also those of sending the job to the process, are yielded and not raised)
+    """
+    if depth <= 0:
+        for item in items:
+            yield (item,) + _timed_load(load, item)
+        return
+    executor = ProcessPoolExecutor(1) if processes else ThreadPoolExecutor(1, thread_name_prefix='saa-loader')
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(_timed_load, load, item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield (item,) + _result(future)
+        while pending:
+            item, future = pending.popleft()
+            yield (item,) + _result(future)
+    finally:
+        # the consumer may stop early: drop what was not started yet
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class Writer:
+    def __init__(self, background=True):
+        """
+        Runs output tasks in order in one background thread (or directly if background is False).
+        Errors of the tasks are raised by close().
+        """
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='saa-writer') if background else None
+        self.futures = []
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) after the tasks submitted before"""
+        if self.executor is None:
+            func(*args, **kwargs)
+            return
+        self.futures = [future for future in self.futures if not future.done() or future.exception()]
+        self.futures.append(self.executor.submit(func, *args, **kwargs))
+
+    def idle(self):
+        """True if all the submitted tasks are finished"""
+        return all(future.done() for future in self.futures)
+
+    def close(self):
+        """Wait for the submitted tasks and raise the first error"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,381 @@
+"""
+ Python implementation of the data preparation of SAA
+ (read_cfg_json.m, prepare_data.m, sort_tsv_files.m and the user functions).
+ The BIDS tree is parsed into one DataFrame per subject that is kept in memory
+ and can be handed directly to the decoding, without MATLAB or .mat files.
+
+ Each subject DataFrame has one row per trial, ordered as the MATLAB structure
+ data.subjects(s).Sess(k).U(u): by session, condition and trial. The column
+ 'sess_ind' holds the session, 'name' the condition and all other columns are
+ the SAA variables (including 'indices', the trial number inside its session).
+"""
+# coding: utf-8
+
+import json
+import os
+import re
+import warnings
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import tsv_cache
+
+# columns that are not SAA variables
+BOOKKEEPING = ('sess_ind', 'name')
+
+
+# independent random streams of a subject
+PREPARATION_STREAM = 0
+PERMUTATION_STREAM = 1
+
+
+def subject_rng(seed, sub_ind, stream=PREPARATION_STREAM):
+    """
+    Random generator of a subject. With a seed it only depends on (seed, sub_ind),
+    so rand_n is the same whatever the order or the process the subject runs in.
+    Each stream (e.g. PERMUTATION_STREAM) gives generators independent of the others,
+    so the label permutations are not related to the random variables of the preparation.
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng(np.random.SeedSequence([int(seed), sub_ind], spawn_key=(stream,) if stream else ()))
+
+
+def variables(df):
+    """Names of the SAA variables of a subject DataFrame"""
+    return [col for col in df if col not in BOOKKEEPING]
+
+
+# ----------------------------------------------------------------------------
+# configuration file
+# ----------------------------------------------------------------------------
+
+def randn(rng, n):
+    """n standard normal values (MATLAB @randn)"""
+    return rng.standard_normal(n)
+
+
+def rand(rng, n):
+    """n uniform values in [0, 1) (MATLAB @rand)"""
+    return rng.random(n)
+
+
+# MATLAB function handles that can be used in the arguments of the cfg functions.
+# They are called as func(rng, n) and return n values. They are module level
+# functions so that a cfg can be sent to a loader process.
+HANDLES = {
+    'randn': randn,
+    'rand': rand,
+}
+
+
+def _split_top_level(string):
+    """Split string by commas and spaces that are not inside quotes or brackets"""
+    items, depth, quoted, current = [], 0, False, ''
+    for char in string:
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char in '[{(':
+            depth += 1
+        elif not quoted and char in ']})':
+            depth -= 1
+        if not quoted and depth == 0 and char in ', ':
+            if current:
+                items.append(current)
+            current = ''
+        else:
+            current += char
+    if current:
+        items.append(current)
+    return items
+
+
+def parse_matlab_value(string):
+    """
+    Evaluate the subset of MATLAB expressions used for 'object' values and
+    function arguments in the cfg JSON file: numbers, logicals, quoted strings,
+    ranges (1:10, 1:2:10), numeric arrays ([1 2 3]), cell arrays ({'a', 'b'})
+    and function handles (@randn).
+    """
+    string = string.strip()
+    if string in ('true', 'false'):
+        return string == 'true'
+    if string.startswith("'") and string.endswith("'") and len(string) > 1:
+        return string[1:-1]
+    if string.startswith('@'):
+        name = string[1:]
+        return HANDLES.get(name, name)
+    if string.startswith('{') and string.endswith('}'):
+        return [parse_matlab_value(item) for item in _split_top_level(string[1:-1])]
+    if string.startswith('[') and string.endswith(']'):
+        values = [parse_matlab_value(item) for item in _split_top_level(string[1:-1])]
+        return [v for value in values for v in (value if isinstance(value, list) else [value])]
+    if re.fullmatch(r'[-+\d.eE]+(:[-+\d.eE]+){1,2}', string):
+        bounds = [float(x) for x in string.split(':')]
+        start, step, stop = (bounds[0], 1, bounds[1]) if len(bounds) == 2 else bounds
+        values = np.arange(start, stop + step / 2., step)
+        return [int(v) if float(v).is_integer() else float(v) for v in values]
+    try:
+        value = float(string)
+    except ValueError:
+        raise ValueError('Cannot evaluate the MATLAB expression "{0}" without MATLAB'.format(string))
+    return int(value) if value.is_integer() else value
+
+
+def read_cfg_json(fname):
+    """
+    Read the JSON configuration file into a dictionary, as read_cfg_json.m does.
+    Every field has a value and a type: 'object' values are evaluated, 'function'
+    values are appended to cfg['functions'] as dict(func=name, args=[...]) and any
+    other type is assigned as it is.
+    """
+    with open(fname) as f:
+        content = json.load(f)
+    cfg = dict(functions=[])
+    for field, entry in content.items():
+        if entry['type'] == 'object':
+            cfg[field] = parse_matlab_value(entry['value'])
+        elif entry['type'] == 'function':
+            if entry['value']:
+                args = parse_matlab_value(entry['args']) if entry.get('args') else []
+                cfg['functions'].append(dict(func=entry['value'], args=args))
+        else:
+            cfg[field] = entry['value']
+    # relative paths are relative to the configuration file
+    cfg_dir = os.path.dirname(os.path.abspath(fname))
+    for field in ('path', 'description_file', 'decoding_sets_file', 'expected_values',
+                  'output_result', 'output_data'):
+        if isinstance(cfg.get(field), str) and not os.path.isabs(cfg[field]):
+            cfg[field] = os.path.join(cfg_dir, cfg[field])
+    return cfg
+
+
+# ----------------------------------------------------------------------------
+# scanning and reading of the BIDS tree
+# ----------------------------------------------------------------------------
+
+def find_subject_files(path, substodo, warn_skipped=True):
+    """
+    Scan the BIDS folder path for the data files of the subjects in substodo.
+    Input:  warn_skipped: warn about every subject folder that is not in substodo
+    Returns:
+            OrderedDict subject number -> list with the data.tsv of each session
+    """
+    paths = {}
+    for folder in sorted(os.listdir(path)):
+        name_split = folder.split('-')
+        if not os.path.isdir(os.path.join(path, folder)) or name_split[0] != 'sub' or len(name_split) != 2:
+            continue
+        subjnr = int(name_split[1])
+        if subjnr not in substodo:
+            if warn_skipped:
+                warnings.warn('Not processing subject {0} as it is not in substodo'.format(subjnr))
+            continue
+        subject_folder = os.path.join(path, folder)
+        sessions = sorted(f for f in os.listdir(subject_folder) if os.path.isdir(os.path.join(subject_folder, f)))
+        if sessions == ['fmri']:
+            # no session folder (only one session)
+            paths[subjnr] = [os.path.join(subject_folder, 'fmri', 'data.tsv')]
+        else:
+            paths[subjnr] = [os.path.join(subject_folder, ses, 'fmri', 'data.tsv') for ses in sessions]
+    missing = [sub for sub in substodo if sub not in paths]
+    if missing:
+        warnings.warn('not processing subjects: {0}, folder not found'.format(missing))
+    return OrderedDict((sub, paths[sub]) for sub in substodo if sub in paths)
+
+
+def add_previous(df):
+    """
+    Duplicate the columns with the data points shifted to the previous trial
+    (add_previous.m). The first trial of each new column is 'n/a'.
+    """
+    previous = df.shift(1).fillna('n/a')
+    previous.columns = ['prev_' + col for col in df]
+    return pd.concat([df, previous], axis=1)
+
+
+def read_session(path, previous_on=False, cache=None):
+    """
+    Read the tsv file of a session (sort_tsv_files.m). Values are kept as strings
+    so that 'n/a' entries can be replaced by their defaults afterwards.
+    cache: tsv_cache.TSVCache with already parsed files, or None
+    Returns:
+            DataFrame sorted by condition, with the trial number in 'indices'
+    """
+    df = tsv_cache.read_tsv(path, cache, dtype=str, keep_default_na=False, index_col=False)
+    if previous_on:
+        df = add_previous(df)
+    df['indices'] = np.arange(1, len(df.index) + 1)
+    # stable sort: the trials of each condition keep their order
+    return df.sort_values('name', kind='stable')
+
+
+# ----------------------------------------------------------------------------
+# preprocessing
+# ----------------------------------------------------------------------------
+
+def read_description(description_file):
+    """
+    Read the description file with the default value for 'n/a' entries and
+    the scale (interval or ordinal) of each variable.
+    Returns:
+            defaults: dict variable -> default value
+            scales: dict variable -> scale
+    """
+    # no header line: every line is a variable
+    description = pd.read_csv(description_file, sep='\t', dtype=str, keep_default_na=False, header=None,
+                              index_col=0, encoding='ISO-8859-1')
+    defaults = description.iloc[:, 0].to_dict()
+    scales = description.iloc[:, 1].to_dict() if description.shape[1] > 1 else {}
+    return defaults, scales
+
+
+def _base_variable(variable):
+    """Name of the variable without the prefix of add_previous"""
+    return variable[len('prev_'):] if variable.startswith('prev_') else variable
+
+
+def replace_defaults(df, defaults):
+    """Replace every 'n/a' value with the default of the variable in the description file"""
+    for col in variables(df):
+        default = defaults.get(_base_variable(col))
+        if default is not None:
+            df[col] = df[col].mask(df[col] == 'n/a', default)
+    return df
+
+
+def to_numeric(df):
+    """
+    Convert the variables to numbers. Variables that are not numeric are coded
+    by the rank (starting with 1) of their sorted values.
+    """
+    for col in variables(df):
+        try:
+            df[col] = pd.to_numeric(df[col])
+        except (ValueError, TypeError):
+            levels = sorted(df[col].unique(), key=str)
+            df[col] = df[col].map({level: i + 1 for i, level in enumerate(levels)})
+    return df
+
+
+def ordinal_columns(columns, scales):
+    """
+    Cumulative indicator variables of the ordinal variables in columns (dict name -> values):
+    <variable>_ge<level> is 1 if the value is greater or equal to the level,
+    for every level except the lowest one.
+    """
+    new_columns = OrderedDict()
+    for col, values in columns.items():
+        if scales.get(_base_variable(col)) != 'ordinal':
+            continue
+        for level in np.unique(values)[1:]:
+            new_columns['{0}_ge{1:g}'.format(col, level)] = (values >= level).astype(int)
+    return new_columns
+
+
+def expand_ordinals(df, scales):
+    """Expand each ordinal variable into cumulative indicator variables (see ordinal_columns)"""
+    new_columns = ordinal_columns(OrderedDict((col, df[col]) for col in variables(df)), scales)
+    if new_columns:
+        df = pd.concat([df, pd.DataFrame(new_columns, index=df.index)], axis=1)
+    return df
+
+
+# ----------------------------------------------------------------------------
+# user functions
+# ----------------------------------------------------------------------------
+
+def add_columns(df, func, colname, ncols=1, rng=None):
+    """
+    Add new SAA variables colname001, colname002, ... generated by func (add_columns.m).
+    func is called as func(rng, n_trials), e.g. HANDLES['randn'].
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    for coln in range(1, int(ncols) + 1):
+        df['{0}{1:03d}'.format(colname, coln)] = func(rng, len(df.index))
+    return df
+
+
+# Python counterparts of the MATLAB functions that can be given in the cfg JSON file.
+# They are called as func(df, *args, rng=rng) on each subject DataFrame.
+FUNCTIONS = {
+    'addcolumns': add_columns,
+    'add_columns': add_columns,
+}
+
+
+def apply_functions(df, functions, rng=None):
+    """
+    Apply the functions of the configuration file sequentially to the data.
+    Functions that cannot be executed are skipped with a warning.
+    """
+    for function in functions:
+        name, args = function['func'], function.get('args') or []
+        try:
+            df = FUNCTIONS[name](df, *args, rng=rng)
+        except Exception:
+            warnings.warn('could not execute {0}'.format(name))
+    return df
+
+
+# ----------------------------------------------------------------------------
+# main entry point
+# ----------------------------------------------------------------------------
+
+def prepare_subject(files, cfg, defaults, scales, rng=None, cache=None):
+    """Read, preprocess and apply the user functions to the sessions of one subject"""
+    sessions = []
+    for sess_ind, path in enumerate(files, 1):
+        df = read_session(path, cfg.get('previous_on', False), cache)
+        df.insert(0, 'sess_ind', sess_ind)
+        sessions.append(df)
+    df = pd.concat(sessions, ignore_index=True)
+    df = replace_defaults(df, defaults)
+    df = to_numeric(df)
+    df = expand_ordinals(df, scales)
+    return apply_functions(df, cfg.get('functions', []), rng)
+
+
+def _load_subject(files, cfg, defaults, scales, seed, cache, sub, chunk_rows=None):
+    if chunk_rows:
+        import ingestion
+        return ingestion.read_subject(files[sub], cfg, defaults, scales, subject_rng(seed, sub), chunk_rows)
+    return prepare_subject(files[sub], cfg, defaults, scales, subject_rng(seed, sub), cache)
+
+
+def subject_loader(cfg, seed=None, cache=None, chunk_rows=None, warn_skipped=True):
+    """
+    Find the data files of the subjects in cfg['substodo'] without reading them yet.
+    Input:  cfg: dictionary returned by read_cfg_json
+            seed: seed for the random variables created by the user functions
+            cache: tsv_cache.TSVCache with already parsed files, or None
+            chunk_rows: read the files in chunks of this many rows into the arrays of a
+                        saa_data.SubjectData (ingestion.read_subject), the cache is not used
+            warn_skipped: warn about the subjects of the BIDS folder that are not in cfg['substodo']
+    Returns:
+            files: OrderedDict subject number -> data files of its sessions
+            load: function that prepares the DataFrame (SubjectData with chunk_rows) of a
+                  subject number (picklable, so it can be sent to another process)
+    """
+    substodo = cfg['substodo']
+    substodo = [int(s) for s in (substodo if isinstance(substodo, list) else [substodo])]
+    defaults, scales = read_description(cfg['description_file'])
+    files = find_subject_files(cfg['path'], substodo, warn_skipped)
+    return files, partial(_load_subject, files, cfg, defaults, scales, seed, cache, chunk_rows=chunk_rows)
+
+
+def prepare_data(cfg, seed=None, cache=None, chunk_rows=None):
+    """
+    Parse the data of all subjects in cfg['substodo'] (prepare_data.m).
+    Input:  cfg: dictionary returned by read_cfg_json
+            seed: seed for the random variables created by the user functions
+            cache: tsv_cache.TSVCache with already parsed files, or None
+            chunk_rows: read the files in chunks (see subject_loader)
+    Returns:
+            OrderedDict subject number -> subject DataFrame (SubjectData with chunk_rows)
+    """
+    files, load = subject_loader(cfg, seed, cache, chunk_rows)
+    return OrderedDict((sub, load(sub)) for sub in files)
@@ -7,10 +7,14 @@
 # coding: utf-8
 
 import argparse
+from collections import OrderedDict
 import numpy as np
 import os
-import pandas as pd
-import scipy.io as sio
+import time
+
+# heavy dependencies (pandas, scipy, scikit-learn, bokeh, MATLAB) are imported
+# by the stages that use them, so --help and batch jobs start quickly
+import instrumentation
 
 class SAA_Interface:
     def __init__(self):
@@ -18,55 +22,412 @@ class SAA_Interface:
         parser = argparse.ArgumentParser()
         parser.add_argument("cfg_file", help="JSON file with the configuration information")
         parser.add_argument("--no_plot", help="Do not produce HTML output figure", action="store_true")
-        parser.add_argument("--no_matlab", help="Do not use MATLAB", action="store_true")
+        parser.add_argument("--lazy_plot", help="Write the accuracies of each block of decoding sets to <output>_detail/ and load "
+                                                "them into the HTML figure when the block is clicked (serve the output folder over http)",
+                            action="store_true")
+        parser.add_argument("--no_matlab", help="Do not use MATLAB. With a JSON cfg_file the full pipeline runs in Python, "
+                                                "otherwise cfg_file is the BIDS folder of the simple example", action="store_true")
         parser.add_argument("--n_subjects", help="Number of subjects to use. Works only if --no_matlab is used.")
         parser.add_argument("--n_sessions", help="Number of sessions to use. Works only if --no_matlab is used.")
+        parser.add_argument("--n_jobs", type=int, default=1, help="Number of processes to decode subjects in parallel (-1: all cores). Works only for the simple example (--no_matlab with a BIDS folder), use --fold_jobs with a JSON cfg_file.")
+        parser.add_argument("--decoder", default="svc", choices=["svc", "lda", "ncm"],
+                            help="Decoding backend: svc (reference, one fit per variable) or the batched lda/ncm. Works only if --no_matlab is used.")
+        parser.add_argument("--fold_jobs", type=int, default=1,
+                            help="Number of threads to fit the cross validation folds of a subject in parallel (svc decoder, -1: all cores). "
+                                 "Works only if --no_matlab is used.")
+        parser.add_argument("--scale", default="all", choices=["all", "across"],
+                            help="Estimate the min0max1 scaling on all samples of a subject, or on the training samples of each fold "
+                                 "(across, svc decoder only). Works only if --no_matlab is used.")
+        parser.add_argument("--seed", type=int, help="Seed for the random variables of each subject. Works only if --no_matlab is used.")
+        parser.add_argument("--no_cache", help="Do not use the cache of parsed tsv files. Works only if --no_matlab is used.", action="store_true")
+        parser.add_argument("--clear_cache", help="Empty the cache of parsed tsv files before running", action="store_true")
+        parser.add_argument("--cache_dir", help="Folder of the cache of parsed tsv files (default: ~/.cache/pySAA)")
+        parser.add_argument("--cache_size", type=float, help="Maximum size of the cache of parsed tsv files in MB (default: 1024)")
+        parser.add_argument("--chunk_rows", type=int, metavar="ROWS",
+                            help="Read the session files in chunks of ROWS rows straight into typed arrays, for very long "
+                                 "sessions that do not fit in memory several times (the cache of parsed tsv files is not used). "
+                                 "Works only if --no_matlab is used.")
+        parser.add_argument("--result_cache", nargs="?", const="", metavar="FILE",
+                            help="Reuse the accuracies of the subjects and decoding sets already decoded with the same data, "
+                                 "decoder and cross validation (sqlite FILE, default: ~/.cache/pySAA-results/results.sqlite, not emptied by --clear_cache), "
+                                 "only new or changed cells are decoded. Works only if --no_matlab is used.")
+        parser.add_argument("--n_permutations", type=int, default=0,
+                            help="Number of label permutations per subject for the group permutation test "
+                                 "(needs --decoder lda or ncm). Works only if --no_matlab is used.")
+        parser.add_argument("--stream", help="Prepare and decode one subject at a time and append its results to "
+                                             "<output_result>_partial.jsonl as soon as it is done. Works only if --no_matlab is used.",
+                            action="store_true")
+        parser.add_argument("--pipeline", type=int, nargs="?", const=2, default=0, metavar="DEPTH",
+                            help="With --stream: read and prepare up to DEPTH subjects (default 2) in a separate loader process "
+                                 "while a subject is decoded, and write the outputs and the partial figure in a background thread. Implies --stream.")
+        parser.add_argument("--resume", help="With --stream: skip the subjects already completed in the partial output",
+                            action="store_true")
+        parser.add_argument("--result_store", metavar="DIR",
+                            help="Write the results of each subject to a memory-mapped store in DIR as soon as it is decoded. "
+                                 "Subjects already in the store are not decoded again (resume a crashed run). "
+                                 "Works only if --no_matlab is used with a JSON cfg_file.")
+        parser.add_argument("--from_shards", metavar="QUEUE",
+                            help="Do not decode, merge the results of the sharded run in the work queue QUEUE (see sharding.py) "
+                                 "into the output tsv and figure. Works only if --no_matlab is used.")
+        parser.add_argument("--shared_matlab", nargs="?", const="", metavar="NAME",
+                            help="Connect to a running shared MATLAB engine (NAME, or the first free one found) instead of starting one. "
+                                 "A new engine is started if none can be connected.")
+        parser.add_argument("--share_matlab", metavar="NAME",
+                            help="Launch a separate MATLAB session shared as NAME (the matlab executable must be on the PATH), "
+                                 "which keeps running after this run, so later runs can reuse it with --shared_matlab. "
+                                 "Quit it from MATLAB when it is not needed anymore.")
+        parser.add_argument("--profile", choices=instrumentation.PROFILERS,
+                            help="Capture the run with cProfile (<output>_profile.prof) or tracemalloc (<output>_tracemalloc.txt). "
+                                 "The timings of the stages are always written to <output>_trace.json.")
         args = parser.parse_args()
+        if args.n_permutations and args.decoder not in ("lda", "ncm"):
+            # the null distribution must come from the decoder of the accuracies
+            parser.error("--n_permutations needs a batched decoder: --decoder lda or ncm")
+        if args.scale == "across" and args.decoder != "svc":
+            # the batched decoders scale with the statistics of all samples
+            parser.error("--scale across needs --decoder svc")
+        if args.result_store and not (args.no_matlab and args.cfg_file.endswith('.json')):
+            # the MATLAB decoding and the simple example do not write to the store
+            parser.error("--result_store needs the python pipeline: --no_matlab with a JSON cfg_file")
         
         self.cfg_file = args.cfg_file
         self.no_plot = args.no_plot
+        self.lazy_plot = args.lazy_plot
         self.no_matlab = args.no_matlab
+        self.result_store = args.result_store
+        # timings of stages, subjects and decoding sets, written next to the output tsv
+        self.tracer = instrumentation.Tracer(args.profile).start()
+        self.output_name = None
+        # subject and decoding set names, set by the decoding of the python pipeline
+        self.columns, self.sets = None, None
+        # second level p-values of the permutation test of the python pipeline
+        self.p_values = None
         if not self.no_matlab:
-            import matlab.engine
+            self.shared_matlab = args.shared_matlab
+            self.share_matlab = args.share_matlab
             self.eng = self._start_matlab()
         else:
             self.n_subs = args.n_subjects
             self.n_sess = args.n_sessions
+            self.n_jobs = args.n_jobs
+            self.seed = args.seed
+            self.chunk_rows = args.chunk_rows
+            self.decoder = args.decoder
+            self.fold_jobs = args.fold_jobs
+            self.scale = args.scale
+            self.n_permutations = args.n_permutations
+            self.stream = args.stream or args.resume or args.pipeline > 0
+            self.pipeline = args.pipeline
+            self.resume = args.resume
+            self.from_shards = args.from_shards
+            self.cache = self._open_cache(args)
+            self.result_cache = self._open_result_cache(args)
+
+    def _open_cache(self, args):
+        """Cache of parsed tsv files, None if --no_cache is set"""
+        import tsv_cache
+        cache_dir = args.cache_dir or tsv_cache.DEFAULT_DIR
+        cache_size = args.cache_size or tsv_cache.DEFAULT_SIZE_MB
+        if args.no_cache and not args.clear_cache:
+            return None
+        cache = tsv_cache.TSVCache(cache_dir, cache_size)
+        if args.clear_cache:
+            cache.clear()
+        return None if args.no_cache else cache
+
+    def _open_result_cache(self, args):
+        """Cache of decoding results of --result_cache, None if unset"""
+        if args.result_cache is None:
+            return None
+        import result_cache
+        return result_cache.ResultCache(args.result_cache or result_cache.DEFAULT_FILE)
 
     def _start_matlab(self):   
-        """ Start matlab engine"""
-        print("Starting loading MATLAB engine")
-        eng = matlab.engine.start_matlab()
-        print("Finished loading MATLAB engine")
+        """
+        Start matlab engine. If --shared_matlab is set, connect first to an already running
+        shared engine, so the startup time is only paid once for successive runs.
+        """
+        import matlab.engine
+        with self.tracer.stage("loading MATLAB engine"):
+            eng = None
+            # keep the engine running at the end if it is shared with other runs
+            self.keep_matlab = False
+            if self.shared_matlab is not None:
+                eng = self._connect_matlab()
+            if eng is None and self.share_matlab is not None:
+                eng = self._launch_shared_matlab()
+            if eng is None:
+                eng = matlab.engine.start_matlab()
+            else:
+                self.keep_matlab = True
+            # a shared session may be in any folder: make the functions of pySAA available
+            # and resolve relative paths as an engine started from here would
+            eng.addpath(os.path.dirname(os.path.abspath(__file__)), nargout=0)
+            eng.cd(os.getcwd(), nargout=0)
         return eng
 
+    def _launch_shared_matlab(self, timeout=300):
+        """
+        Launch a separate MATLAB session shared as --share_matlab and connect to it. Unlike an
+        engine of start_matlab(), it does not end with this Python process.
+        Returns None if MATLAB cannot be launched or does not share itself within timeout seconds.
+        """
+        import subprocess
+        import matlab.engine
+        command = ["matlab", "-nodesktop", "-nosplash", "-r",
+                   "matlab.engine.shareEngine('{0}')".format(self.share_matlab)]
+        try:
+            subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError as error:
+            print("Could not launch a shared MATLAB session ({0}), starting an engine that ends with this run".format(error))
+            return None
+        start = time.time()
+        while time.time() - start < timeout:
+            if self.share_matlab in matlab.engine.find_matlab():
+                print("Launched shared MATLAB session {0}".format(self.share_matlab))
+                return matlab.engine.connect_matlab(self.share_matlab)
+            time.sleep(1)
+        print("MATLAB session {0} was not shared after {1} s, starting an engine that ends with this run".format(
+            self.share_matlab, timeout))
+        return None
+
+    def _connect_matlab(self):
+        """
+        Connect to the shared engine named by --shared_matlab, or to the first engine of the
+        running pool that accepts the connection (engines busy with other jobs are skipped).
+        Returns None if there is no engine to connect to.
+        """
+        import matlab.engine
+        names = [self.shared_matlab] if self.shared_matlab else list(matlab.engine.find_matlab())
+        for name in names:
+            try:
+                eng = matlab.engine.connect_matlab(name)
+            except matlab.engine.EngineError:
+                continue
+            print("Connected to shared MATLAB engine {0}".format(name))
+            return eng
+        print("No shared MATLAB engine found, starting a new one")
+        return None
+
+    def quit_matlab(self):
+        """Quit the MATLAB engine, unless it is shared with other runs"""
+        if not self.keep_matlab:
+            self.eng.quit()
+
+    @property
+    def python_pipeline(self):
+        """True if the whole pipeline runs in Python (--no_matlab with a JSON cfg file)"""
+        return self.no_matlab and self.cfg_file.endswith('.json')
+
     def load_cfg_json(self):
-        """Load cfg file (via MATLAB)"""
-        print("Starting loading cfg file")
-        # path to the configuration file
-        self.cfg_file = os.path.abspath(self.cfg_file)
-        # MATLAB function that reorganizes the content of the JSON into a structure to be used in latter stages
-        cfg_mat = self.eng.read_cfg_json(self.cfg_file)
-        # Load the saved structure
-        cfg_content = sio.loadmat(cfg_mat, struct_as_record=False, squeeze_me=True)
-        print("Finished loading cfg file")
-        self.cfg_mat, self.cfg_content = cfg_mat, cfg_content
+        """Load cfg file (via MATLAB, or in Python with --no_matlab)"""
+        with self.tracer.stage("loading cfg file"):
+            # path to the configuration file
+            self.cfg_file = os.path.abspath(self.cfg_file)
+            if self.no_matlab:
+                import preparation
+                self.cfg_content = preparation.read_cfg_json(self.cfg_file)
+            else:
+                import scipy.io as sio
+                # MATLAB function that reorganizes the content of the JSON into a structure to be used in latter stages
+                self.cfg_mat = self.eng.read_cfg_json(self.cfg_file)
+                # Load the saved structure
+                self.cfg_content = sio.loadmat(self.cfg_mat, struct_as_record=False, squeeze_me=True)
+        self.output_name, _ = os.path.splitext(self.cfg_content['output_result'])
 
     def prepare_data(self):
-        """Parsing of data to a more convenient format (via MATLAB)"""
-        print("Starting preparing data")
-        self.eng.prepare_data(self.cfg_mat, nargout=0)
-        print("Finished preparing data")
+        """Parsing of data to a more convenient format (via MATLAB, or in memory with --no_matlab)"""
+        with self.tracer.stage("preparing data"):
+            if self.no_matlab:
+                import preparation
+                from saa_data import load_subject
+                self.files, self.load = preparation.subject_loader(self.cfg_content, self.seed, self.cache,
+                                                                   self.chunk_rows)
+                if self.result_store:
+                    # prepared when decoded, subjects already in the result store are not read again
+                    self.data = None
+                    return
+                # columnar representation that is handed to the decoding
+                self.data = OrderedDict((sub, load_subject(self.load, sub)) for sub in self.files)
+            else:
+                self.eng.prepare_data(self.cfg_mat, nargout=0)
 
     def decode_data(self):
-        """"Decoding process (via MATLAB)"""
-        print("Starting decoding")
-        accuracies = np.asarray(self.eng.extract_and_decode(self.cfg_mat))
-        print("Finished decoding")
-        self.accuracies = accuracies
+        """"Decoding process (via MATLAB, or in Python with --no_matlab)"""
+        with self.tracer.stage("decoding"):
+            if self.no_matlab:
+                self._decode_data_python()
+            else:
+                self.accuracies = np.asarray(self.eng.extract_and_decode(self.cfg_mat))
+
+    def _decode_data_python(self):
+        """Decode the decoding sets of the prepared subjects, one subject per column of the accuracies"""
+        sets = self._read_decoding_sets()
+        from saa_data import load_subject
+        self.columns = ['sub-{0:02d}'.format(sub) for sub in self.files]
+        # one fold per session
+        store = self._open_result_store(max(len(paths) for paths in self.files.values()))
+        accuracies, nulls = [], []
+        for sub_ind, sub in enumerate(self.files):
+            if store is not None and store.done[sub_ind]:
+                print("Skipping {0}, already in the result store".format(self.columns[sub_ind]))
+                accuracies.append(store.accuracies[:, sub_ind])
+                if self.n_permutations:
+                    nulls.append(store.permutations[:, :, sub_ind])
+                continue
+            if self.data is not None:
+                subject = self.data[sub]
+            else:
+                with self.tracer.stage("preparing " + self.columns[sub_ind], 'subject'):
+                    subject = load_subject(self.load, sub)
+            with self.tracer.stage(self.columns[sub_ind], 'subject'):
+                scores, null = self._decode_subject(sub_ind, sub, subject, sets, store)
+            accuracies.append(scores)
+            nulls.append(null)
+        self.accuracies = np.array(accuracies).T
+        self._permutation_test(nulls)
+        self._report_result_cache()
+
+    def _read_decoding_sets(self):
+        """Decoding sets of the cfg file, their names are kept in self.sets"""
+        import decoding_sets
+        sets = decoding_sets.read_decoding_sets(self.cfg_content['decoding_sets_file'])
+        self.sets = [decoding_sets.set_name(s) for s in sets]
+        return sets
+
+    def _decode_subject(self, sub_ind, sub, subject, sets, store=None, writer=None):
+        """
+        Decode one prepared subject (python pipeline) and write it to the result store
+        (in the background if a pipeline.Writer is given).
+        Returns:
+            accuracies minus chance in percent, permutation null (None without --n_permutations)
+        """
+        import decoders
+        from preparation import PERMUTATION_STREAM, subject_rng
+        from sklearn.model_selection import LeaveOneGroupOut
+        result = decoders.decode_subject(subject, sets, LeaveOneGroupOut(), self.decoder,
+                                         self.cfg_content.get('labelnames'), return_folds=True,
+                                         n_permutations=self.n_permutations, rng=subject_rng(self.seed, sub, PERMUTATION_STREAM),
+                                         n_jobs=self.fold_jobs, scale=self.scale, cache=self.result_cache)
+        scores, folds = 100 * result[0], 100 * result[2]
+        null = 100 * result[3] if self.n_permutations else None
+        if store is not None:
+            if writer is not None:
+                writer.submit(store.write_subject, sub_ind, scores, folds, null)
+            else:
+                store.write_subject(sub_ind, scores, folds, null)
+        return scores, null
+
+    def _report_result_cache(self):
+        """Print how many cells of the accuracies were reused from --result_cache"""
+        if self.result_cache is not None:
+            print("Result cache: {0} cells reused, {1} decoded".format(self.result_cache.hits, self.result_cache.misses))
+
+    def _permutation_test(self, nulls):
+        """Group permutation test of the accuracies if --n_permutations is set"""
+        if not self.n_permutations:
+            return
+        if any(null is None for null in nulls):
+            print("Permutations of some subjects are missing, no permutation test")
+            return
+        import permutation
+        with self.tracer.stage("permutation test"):
+            self.p_values = permutation.group_permutation_test(self.accuracies, nulls,
+                                                               rng=np.random.default_rng(self.seed))
+
+    def stream_data(self):
+        """
+        Prepare and decode the subjects one at a time (python pipeline, --stream).
+        The result of each subject is appended to <output_result>_partial.jsonl as soon as
+        it is ready, failed subjects are reported and skipped, and with --resume the subjects
+        already completed in that file are not processed again.
+        With --pipeline the next subjects are prepared while one is decoded, and the outputs
+        (and <output_result>_partial.html) are written in the background.
+        """
+        with self.tracer.stage("streaming subjects"):
+            stream_file = self._stream_subjects()
+        print("Partial results in {0}".format(stream_file))
+
+    def _stream_subjects(self):
+        """Loop of stream_data, returns the name of the partial output"""
+        from functools import partial
+        import pipeline
+        import preparation
+        import streaming
+        from saa_data import load_subject
+        sets = self._read_decoding_sets()
+        files, load = preparation.subject_loader(self.cfg_content, self.seed, self.cache, self.chunk_rows)
+        columns = self.columns = ['sub-{0:02d}'.format(sub) for sub in files]
+        stream_file = self.output_name + '_partial.jsonl'
+        done = streaming.read_records(stream_file, self.sets) if self.resume else {}
+        if self.resume:
+            outdated = [column for column in streaming.read_records(stream_file) if column not in done]
+            if outdated:
+                print("Decoding again {0}: completed with other decoding sets".format(', '.join(outdated)))
+        store = self._open_result_store(max(len(paths) for paths in files.values()))
+        progress = streaming.Progress(len(files), sum(column in done for column in columns))
+        nulls, todo = {}, []
+        for sub_ind, sub in enumerate(files):
+            if columns[sub_ind] not in done:
+                todo.append(sub)
+            elif store is not None and self.n_permutations and store.done[sub_ind]:
+                nulls[columns[sub_ind]] = store.permutations[:, :, sub_ind]
+        sub_inds = {sub: sub_ind for sub_ind, sub in enumerate(files)}
+
+        partial_html = self.output_name + '_partial.html'
+        with streaming.ResultStream(stream_file, resume=self.resume) as stream, \
+                pipeline.Writer(background=self.pipeline > 0) as writer:
+            # the preparation is mostly python code, it is overlapped in a separate process
+            loaded = pipeline.prefetch(todo, partial(load_subject, load), self.pipeline, processes=True)
+            for sub, subject, error, load_seconds in loaded:
+                sub_ind = sub_inds[sub]
+                start = time.time()
+                try:
+                    if error is not None:
+                        raise error
+                    with self.tracer.stage(columns[sub_ind], 'subject'):
+                        scores, nulls[columns[sub_ind]] = self._decode_subject(sub_ind, sub, subject, sets, store,
+                                                                               writer if self.pipeline else None)
+                except Exception as error:
+                    writer.submit(stream.write_error, columns[sub_ind], error)
+                    progress.fail(columns[sub_ind], error)
+                    continue
+                seconds = load_seconds + time.time() - start
+                writer.submit(stream.write, columns[sub_ind], self.sets, scores, seconds)
+                progress.update(columns[sub_ind], seconds)
+                if self.pipeline and not self.no_plot and writer.idle():
+                    # refresh the figure of the completed subjects when the writer has time
+                    writer.submit(self._plot_partial, stream_file, partial_html)
+        self.accuracies, _, self.columns = streaming.read_results(stream_file, columns, self.sets)
+        self._permutation_test([nulls.get(column) for column in self.columns])
+        self._report_result_cache()
+        return stream_file
+
+    def _plot_partial(self, stream_file, output_html):
+        """Figure of the subjects completed so far (background task of --pipeline)"""
+        import streaming
+        try:
+            streaming.plot_partial(stream_file, output_html, show=False)
+        except Exception as error:
+            print("Could not plot the partial results: {0!r}".format(error))
+
+    def merge_shards(self):
+        """Accuracies, decoding sets and subjects of the sharded run in the queue of --from_shards"""
+        import sharding
+        with self.tracer.stage("merging shards"):
+            self.accuracies, self.sets, self.columns = sharding.merge(self.from_shards)
+
+    def _open_result_store(self, n_folds):
+        """Result store of --result_store, None if unset"""
+        if not self.result_store:
+            return None
+        from result_store import ResultStore
+        return ResultStore.create(self.result_store, self.sets, self.columns, n_folds, self.n_permutations)
 
     def _concatenate_set(self, analysis):
         """Concatenate columns of non null pandas Data Series"""
+        import pandas as pd
         return ' '.join(filter(lambda x: not pd.isnull(x), analysis))
 
     def post_process(self):
@@ -79,24 +440,31 @@ class SAA_Interface:
             sets: list with strings corresponding to each decoding set
             output_html: path to the file where the output figure will be displayed.
         """
-        # load file with the sets of decoding variables
-        analyses = pd.read_csv(self.cfg_content['decoding_sets_file'], sep='\t', header=-1).T
+        import pandas as pd
         # load file with the expected_values
         expected_file = self.cfg_content.get('expected_values')
         expected_df = pd.read_csv(expected_file, sep='\t', index_col=0) if expected_file else None
         # Save subject ids as strings
-        columns = ['sub-{0:02d}'.format(i) for i in range(1, 1 + len(self.accuracies.T))]
+        columns = self.columns or ['sub-{0:02d}'.format(i) for i in range(1, 1 + len(self.accuracies.T))]
         # Save the decoding variables
-        sets = [self._concatenate_set(analyses[i]) for i, a in enumerate(analyses)]
+        if self.sets is not None:
+            sets = self.sets
+        else:
+            # load file with the sets of decoding variables
+            analyses = pd.read_csv(self.cfg_content['decoding_sets_file'], sep='\t', header=None).T
+            sets = [self._concatenate_set(analyses[i]) for i, a in enumerate(analyses)]
 
         # Save as a data frame, it is more convenient for the box plot
         df = pd.DataFrame(self.accuracies, index=sets, columns=columns)
 
         # Save results in a tsv
-        output_name, _ = os.path.splitext(self.cfg_content['output_result'])
-        output_tsv = os.path.join(output_name + '.tsv')
-        output_html = os.path.join(output_name + '.html')
+        output_tsv = os.path.join(self.output_name + '.tsv')
+        output_html = os.path.join(self.output_name + '.html')
         df.to_csv(output_tsv, sep='\t', index=True, header=False)
+        if self.p_values is not None:
+            # one-sided group permutation p-values, uncorrected and family-wise corrected
+            p_df = pd.DataFrame(dict(p_values=self.p_values['p_values'], p_fwe=self.p_values['p_fwe']), index=sets)
+            p_df.to_csv(self.output_name + '_pvalues.tsv', sep='\t', index=True)
         print("******")
         print(self.cfg_content)
         
@@ -106,17 +474,31 @@ class SAA_Interface:
         """Plots using bokeh if flag --no_plot was unset"""
         if not self.no_plot:    
             import visualization
-            vis = visualization.Visualization(self.accuracies, df, expected_df,\
-                                    output_html, columns=columns, sets=sets)
+            p_values = self.p_values['p_values'] if self.p_values is not None else None
+            with self.tracer.stage("plotting"):
+                vis = visualization.Visualization(self.accuracies, df, expected_df,\
+                                        output_html, columns=columns, sets=sets, p_values=p_values,
+                                        lazy=self.lazy_plot)
 
         print("SAA Finished successfully")
+
+    def write_trace(self):
+        """Stop the instrumentation and write the trace (and profile) next to the output tsv"""
+        self.tracer.stop()
+        if self.output_name is None:
+            return
+        trace_file = self.tracer.write(self.output_name)
+        print("Timings written to {0}".format(trace_file))
        
     def simple_example(self):
         """Execute a python based analysis using a minimal setup"""
         import simple_example
-        accuracies, df, sets, columns = simple_example.run(self.cfg_file, self.n_subs, self.n_sess)
+        self.output_name = 'output/result_simple'
+        with self.tracer.stage("simple example"):
+            accuracies, df, sets, columns = simple_example.run(self.cfg_file, self.n_subs, self.n_sess,
+                                                               self.n_jobs, self.seed, self.decoder, self.cache)
         self.accuracies = accuracies.T
-        self.visualize(df, expected_df=None, output_html='output/result_simple.html', columns=columns, sets=sets)
+        self.visualize(df, expected_df=None, output_html=self.output_name + '.html', columns=columns, sets=sets)
 
 
 if __name__ == '__main__':
@@ -124,24 +506,36 @@ if __name__ == '__main__':
     # create object that will manage processes
     saa = SAA_Interface()
     
-    if saa.no_matlab:
-        import simple_example
-        saa.simple_example()
-    else:
-        # Load JSON file
-        saa.load_cfg_json()
+    try:
+        if saa.no_matlab and not saa.python_pipeline:
+            import simple_example
+            saa.simple_example()
+        else:
+            # Load JSON file
+            saa.load_cfg_json()
 
-        # Prepare data
-        saa.prepare_data()
+            if saa.no_matlab and saa.from_shards:
+                # Results of shards decoded by other processes
+                saa.merge_shards()
+            elif saa.no_matlab and saa.stream:
+                # Prepare and decode one subject at a time
+                saa.stream_data()
+            else:
+                # Prepare data
+                saa.prepare_data()
 
-        # Decode data and save it as a numpy array
-        saa.decode_data()
+                # Decode data and save it as a numpy array
+                saa.decode_data()
 
-        # Post-processing to plot
-        df, expected_df, columns, sets, output_html = saa.post_process()
+            # Post-processing to plot
+            df, expected_df, columns, sets, output_html = saa.post_process()
 
-        # Plot
-        saa.visualize(df, expected_df, output_html, columns, sets)
+            # Plot
+            saa.visualize(df, expected_df, output_html, columns, sets)
 
-        #Quit MATLAB process
-        saa.eng.quit()
+            #Quit MATLAB process
+            if not saa.no_matlab:
+                saa.quit_matlab()
+    finally:
+        # timings are also written if the run fails
+        saa.write_trace()
@@ -0,0 +1,89 @@
+"""
+ Content-addressed cache of decoding results.
+ The fold accuracies of every cell of the result matrix (one subject and one
+ decoding set) are stored under a hash of everything they depend on: the data
+ of the variables of the set, the conditions and sessions of the samples, the
+ names of the expanded variables (a regular expression matching the same
+ variables gives the same key) and the decoder, cross validation and scaling.
+ When a decoding set or a subject is added or changed, only its cells are
+ decoded again. The cache is a sqlite file that several processes can share.
+"""
+# coding: utf-8
+
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+# own directory, apart from the cache of parsed tsv files (tsv_cache.DEFAULT_DIR) and its --clear_cache
+DEFAULT_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'pySAA-results', 'results.sqlite')
+
+
+def array_hash(values):
+    """sha1 of the content of an array (numbers by their bytes, anything else by its text)"""
+    values = np.asarray(values)
+    sha = hashlib.sha1(str(values.dtype).encode())
+    if values.dtype.kind in 'biufc':
+        sha.update(np.ascontiguousarray(values).tobytes())
+    else:
+        sha.update('\0'.join(map(str, values.ravel())).encode())
+    return sha.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, filename=DEFAULT_FILE):
+        """Open (or create) the cache in the sqlite file filename"""
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cells (key TEXT PRIMARY KEY, folds BLOB)')
+        self.connection.commit()
+        self.hits = self.misses = 0
+
+    def keys(self, subject, features, masks, config):
+        """
+        Key of each decoding set of a subject.
+        Input:  subject: saa_data.SubjectData (after the selection of conditions)
+                features, masks: as returned by decoding_sets.set_masks
+                config: JSON serializable description of the decoder, cv and scaling
+        Returns:
+                list of keys, one per column of masks
+        """
+        design = [array_hash(subject.labels), array_hash(subject.sess_ind), config]
+        columns = {name: array_hash(subject.columns[name]) for name in features}
+        keys = []
+        for mask in np.asarray(masks).T:
+            names = [name for name, used in zip(features, mask) if used]
+            content = json.dumps([design, names, [columns[name] for name in names]])
+            keys.append(hashlib.sha1(content.encode()).hexdigest())
+        return keys
+
+    def get(self, keys):
+        """dict key -> fold accuracies of the keys that are in the cache"""
+        found = {}
+        # sqlite limits the number of parameters of a query
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = 'SELECT key, folds FROM cells WHERE key IN ({0})'.format(','.join('?' * len(chunk)))
+            for key, folds in self.connection.execute(query, chunk):
+                found[key] = np.frombuffer(folds, dtype=np.float64)
+        self.hits += len(found)
+        self.misses += len(set(keys)) - len(found)
+        return found
+
+    def put(self, results):
+        """Store the fold accuracies of a dict key -> numpy array"""
+        self.connection.executemany('INSERT OR REPLACE INTO cells VALUES (?, ?)',
+                                    [(key, np.asarray(folds, dtype=np.float64).tobytes())
+                                     for key, folds in results.items()])
+        self.connection.commit()
+
+    def clear(self):
+        """Remove all the cached results"""
+        self.connection.execute('DELETE FROM cells')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,100 @@
+"""
+ Memory-mapped store for the results of SAA.
+ The accuracies (sets x subjects), the accuracies of every fold
+ (sets x subjects x folds) and optionally the accuracies of permuted labels
+ (permutations x sets x subjects) are kept in .npy files that are written as
+ soon as a subject is decoded and read lazily with numpy memmaps. The subjects
+ that were completely written are flagged, so a crashed run can be resumed.
+"""
+# coding: utf-8
+
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+class ResultStore:
+    META = 'meta.json'
+
+    def __init__(self, directory, mode='r'):
+        """
+        Open an existing store. Use ResultStore.create to make a new one.
+        Input:  directory: folder of the store
+                mode: 'r' to read, 'r+' to write subjects
+        """
+        self.directory = directory
+        with open(os.path.join(directory, self.META)) as f:
+            meta = json.load(f)
+        self.sets, self.subjects = meta['sets'], meta['subjects']
+        self.n_folds, self.n_permutations = meta['n_folds'], meta['n_permutations']
+        self.accuracies = self._open('accuracies', mode)
+        self.folds = self._open('folds', mode)
+        self.permutations = self._open('permutations', mode) if self.n_permutations else None
+        self.done = self._open('done', mode)
+
+    def _open(self, name, mode):
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, directory, sets, subjects, n_folds, n_permutations=0):
+        """
+        Create the store, or open it for writing if a store with the same
+        sets and subjects already exists (to resume a run).
+        Input:  sets: names of the decoding sets
+                subjects: names of the subjects
+                n_folds: maximum number of cross validation folds of a subject
+                n_permutations: number of label permutations stored per subject
+        """
+        meta = dict(sets=list(sets), subjects=list(subjects), n_folds=int(n_folds),
+                    n_permutations=int(n_permutations))
+        meta_file = os.path.join(directory, cls.META)
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    return cls(directory, 'r+')
+            raise ValueError('{0} contains results of another analysis'.format(directory))
+        os.makedirs(directory, exist_ok=True)
+        n_sets, n_subs = len(sets), len(subjects)
+        shapes = dict(accuracies=(n_sets, n_subs), folds=(n_sets, n_subs, n_folds))
+        if n_permutations:
+            shapes['permutations'] = (n_permutations, n_sets, n_subs)
+        for name, shape in shapes.items():
+            array = open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=np.float64, shape=shape)
+            array[:] = np.nan
+            array.flush()
+        open_memmap(os.path.join(directory, 'done.npy'), mode='w+', dtype=bool, shape=(n_subs,)).flush()
+        # the meta data is written last: a store without it is incomplete
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+        return cls(directory, 'r+')
+
+    def write_subject(self, sub_ind, accuracies, folds=None, permutations=None):
+        """
+        Store the results of the subject at position sub_ind and flag it as done.
+        Input:  accuracies: n_sets
+                folds: n_folds x n_sets, fewer folds than the store are padded with nan
+                permutations: n_permutations x n_sets
+        """
+        self.accuracies[:, sub_ind] = accuracies
+        self.accuracies.flush()
+        if folds is not None:
+            folds = np.asarray(folds)
+            self.folds[:, sub_ind, :len(folds)] = folds.T
+            self.folds.flush()
+        if permutations is not None:
+            self.permutations[:, :, sub_ind] = permutations
+            self.permutations.flush()
+        # flag only after the data is on disk
+        self.done[sub_ind] = True
+        self.done.flush()
+
+    def completed(self):
+        """Names of the subjects that are completely stored"""
+        return [sub for sub, done in zip(self.subjects, self.done) if done]
+
+    def completed_accuracies(self):
+        """Accuracies (sets x completed subjects) and the names of the completed subjects"""
+        done = np.asarray(self.done)
+        return self.accuracies[:, done], [sub for sub, d in zip(self.subjects, done) if d]
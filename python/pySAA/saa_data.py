@@ -0,0 +1,124 @@
+"""
+ Columnar in-memory representation of the SAA data of a subject.
+ Instead of data.subjects(s).Sess(k).U(u).SAAdata(v).data_points, a subject
+ holds one contiguous typed numpy array per variable, integer arrays with the
+ session and condition of each sample, and a dictionary variable name -> column.
+ Selecting the variables of a decoding set returns the stored arrays themselves,
+ nothing is copied until a feature matrix is requested.
+"""
+# coding: utf-8
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import preparation
+
+
+class SubjectData:
+    def __init__(self, columns, sess_ind, cond_ind, conditions):
+        """
+        Input:  columns: OrderedDict variable name -> 1d numpy array (one value per sample)
+                sess_ind: session (starting with 1) of each sample
+                cond_ind: index in conditions of the condition of each sample
+                conditions: names of the conditions
+        """
+        self.columns = OrderedDict((name, np.ascontiguousarray(values)) for name, values in columns.items())
+        self.sess_ind = np.asarray(sess_ind, dtype=np.int32)
+        self.cond_ind = np.asarray(cond_ind, dtype=np.int32)
+        self.conditions = list(conditions)
+        self.index = {name: i for i, name in enumerate(self.columns)}
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Build from a subject DataFrame as returned by preparation.prepare_data"""
+        conditions, cond_ind = np.unique(df['name'].to_numpy(), return_inverse=True)
+        columns = OrderedDict((name, df[name].to_numpy()) for name in preparation.variables(df))
+        return cls(columns, df['sess_ind'].to_numpy(), cond_ind, conditions)
+
+    @property
+    def variables(self):
+        """Names of the SAA variables"""
+        return list(self.columns)
+
+    @property
+    def labels(self):
+        """Condition name of each sample"""
+        return np.asarray(self.conditions, dtype=object)[self.cond_ind]
+
+    def __len__(self):
+        return len(self.sess_ind)
+
+    def view(self, names):
+        """
+        Zero-copy selection of variables: OrderedDict name -> the stored array.
+        Names that are not variables of the subject raise a KeyError.
+        """
+        return OrderedDict((name, self.columns[name]) for name in names)
+
+    def matrix(self, names, dtype=float):
+        """Feature matrix n_samples x len(names) of the variables in names (one copy)"""
+        out = np.empty((len(self), len(names)), dtype=dtype, order='F')
+        for col, name in enumerate(names):
+            out[:, col] = self.columns[name]
+        return out
+
+    def select_conditions(self, conditions):
+        """New SubjectData with only the samples of the given conditions"""
+        keep = np.isin(self.labels, list(conditions))
+        columns = OrderedDict((name, values[keep]) for name, values in self.columns.items())
+        return SubjectData(columns, self.sess_ind[keep], self.cond_ind[keep], self.conditions)
+
+    def nbytes(self):
+        """Memory used by the arrays of the subject"""
+        return sum(values.nbytes for values in self.columns.values()) + self.sess_ind.nbytes + self.cond_ind.nbytes
+
+
+def load_subject(load, sub):
+    """SubjectData of subject number sub, load is a loader of preparation.subject_loader"""
+    subject = load(sub)
+    return subject if isinstance(subject, SubjectData) else SubjectData.from_dataframe(subject)
+
+
+def _as_list(value):
+    """loadmat with squeeze_me returns single struct elements as scalars"""
+    if isinstance(value, np.ndarray):
+        return list(value.flat)
+    return [value]
+
+
+def _mat_subject_dataframe(subject):
+    """Flatten the Sess(k).U(u).SAAdata(v) structure of one subject into a DataFrame"""
+    frames = []
+    for sess_ind, sess in enumerate(_as_list(subject.Sess), 1):
+        for u in _as_list(sess.U):
+            columns = OrderedDict()
+            for entry in _as_list(u.SAAdata):
+                # variables are stored as 1x1 cells
+                variable = entry.variable if isinstance(entry.variable, str) else _as_list(entry.variable)[0]
+                if variable in preparation.BOOKKEEPING:
+                    # sort_tsv_files.m also stores the condition column 'name' as a variable,
+                    # the condition is taken from U.name below
+                    continue
+                columns[variable] = _as_list(entry.data_points)
+            frame = pd.DataFrame(columns)
+            frame.insert(0, 'name', u.name)
+            frame.insert(0, 'sess_ind', sess_ind)
+            frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_mat(mat_file):
+    """
+    Load the data saved by prepare_data.m (beh_cfg.output_data).
+    Returns:
+            list with the SubjectData of each subject
+    """
+    import scipy.io as sio
+    data = sio.loadmat(mat_file, struct_as_record=False, squeeze_me=True)
+    subjects = []
+    for subject in _as_list(data['subjects']):
+        df = preparation.to_numeric(_mat_subject_dataframe(subject))
+        subjects.append(SubjectData.from_dataframe(df))
+    return subjects
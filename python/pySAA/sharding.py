@@ -0,0 +1,248 @@
+"""
+ Sharded runs of the python path of SAA.
+ The subjects and the decoding sets of a cfg file are split into independent
+ shards that are kept in a file-based work queue (a folder). Any number of
+ workers, on any node that sees the folder, take shards from the queue and
+ write their accuracies; the merge step puts them back together into the
+ accuracy matrix of a single run.
+
+     python sharding.py plan cfg.json queue --subject_shards 20 --set_shards 2 --decoder lda --seed 0
+     python sharding.py work queue          # once per process / node / array job
+     python sharding.py status queue
+     python pySAA.py cfg.json --no_matlab --from_shards queue
+
+ Queue folder: plan.json, pending/, running/, done/ and failed/ hold one JSON
+ file per shard, a shard is claimed by moving it from pending/ to running/
+ (an atomic rename), its accuracies are written to results/<shard>.npz.
+"""
+# coding: utf-8
+
+import argparse
+import json
+import os
+import socket
+import sys
+import traceback
+
+import numpy as np
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def _split(n, n_shards):
+    """Contiguous [start, stop) ranges of n items in at most n_shards shards"""
+    bounds = np.linspace(0, n, min(n_shards, n) + 1).round().astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _write_json(filename, content):
+    """Write a JSON file atomically"""
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def plan(cfg_file, queue_dir, subject_shards=1, set_shards=1, decoder='svc', seed=None):
+    """
+    Split a run into shards and put them in the work queue queue_dir.
+    Input:  cfg_file: JSON cfg file of the python pipeline
+            subject_shards: number of groups of subjects
+            set_shards: number of groups of decoding sets
+            decoder: decoder of all shards
+            seed: seed of the random variables, every shard of a subject must use the same
+                  one, so a random seed is drawn if None
+    Returns:
+            list of the shard ids
+    """
+    import decoding_sets
+    import preparation
+    cfg_file = os.path.abspath(cfg_file)
+    cfg = preparation.read_cfg_json(cfg_file)
+    files, _ = preparation.subject_loader(cfg)
+    subjects = list(files)
+    sets = [decoding_sets.set_name(s) for s in decoding_sets.read_decoding_sets(cfg['decoding_sets_file'])]
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 32)
+    if os.path.exists(os.path.join(queue_dir, 'plan.json')):
+        raise ValueError('{0} already contains a plan'.format(queue_dir))
+    for folder in STATES + ('results',):
+        os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+    shards = []
+    for sub_start, sub_stop in _split(len(subjects), subject_shards):
+        for set_start, set_stop in _split(len(sets), set_shards):
+            shard = dict(id='sub{0:04d}-set{1:04d}'.format(sub_start, set_start), cfg_file=cfg_file,
+                         subjects=subjects[sub_start:sub_stop], sets=[set_start, set_stop],
+                         decoder=decoder, seed=seed)
+            _write_json(os.path.join(queue_dir, 'pending', shard['id'] + '.json'), shard)
+            shards.append(shard['id'])
+    # the plan is written last: a queue without it is incomplete
+    _write_json(os.path.join(queue_dir, 'plan.json'),
+                dict(cfg_file=cfg_file, subjects=subjects, sets=sets, decoder=decoder, seed=seed, shards=shards))
+    return shards
+
+
+def run_shard(shard, cache=None):
+    """
+    Decode the subjects and decoding sets of a shard.
+    Returns:
+            accuracies minus chance in percent, n_sets x n_subjects of the shard
+    """
+    import decoders
+    import decoding_sets
+    import preparation
+    from sklearn.model_selection import LeaveOneGroupOut
+    cfg = preparation.read_cfg_json(shard['cfg_file'])
+    # only the subjects of the shard are searched and read
+    cfg['substodo'] = shard['subjects']
+    start, stop = shard['sets']
+    sets = decoding_sets.read_decoding_sets(cfg['decoding_sets_file'])[start:stop]
+    # the subjects of the other shards are skipped on purpose
+    files, load = preparation.subject_loader(cfg, shard['seed'], cache, warn_skipped=False)
+    missing = [sub for sub in shard['subjects'] if sub not in files]
+    if missing:
+        raise ValueError('Subjects {0} of shard {1} not found'.format(missing, shard['id']))
+    accuracies = [decoders.decode_subject(load(sub), sets, LeaveOneGroupOut(), shard['decoder'],
+                                          cfg.get('labelnames'))[0] for sub in shard['subjects']]
+    return 100 * np.array(accuracies).T
+
+
+def claim(queue_dir):
+    """
+    Take the next pending shard of the queue.
+    Returns:
+            shard dict, None if no shard is pending
+    """
+    pending = os.path.join(queue_dir, 'pending')
+    for name in sorted(os.listdir(pending)):
+        if not name.endswith('.json'):
+            continue
+        running = os.path.join(queue_dir, 'running', name)
+        try:
+            # only one worker can move the file
+            os.rename(os.path.join(pending, name), running)
+        except OSError:
+            continue
+        with open(running) as f:
+            shard = json.load(f)
+        shard['worker'] = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        _write_json(running, shard)
+        return shard
+    return None
+
+
+def work(queue_dir, cache=None, max_shards=None):
+    """
+    Process pending shards until the queue is empty (or max_shards were processed).
+    Failed shards are moved to failed/ with their error and the worker goes on.
+    Returns:
+            number of shards processed
+    """
+    processed = 0
+    while max_shards is None or processed < max_shards:
+        shard = claim(queue_dir)
+        if shard is None:
+            break
+        running = os.path.join(queue_dir, 'running', shard['id'] + '.json')
+        try:
+            accuracies = run_shard(shard, cache)
+        except Exception as error:
+            traceback.print_exc()
+            shard['error'] = repr(error)
+            _write_json(os.path.join(queue_dir, 'failed', shard['id'] + '.json'), shard)
+            os.remove(running)
+            print("Shard {0} FAILED: {1!r}".format(shard['id'], error))
+        else:
+            result = os.path.join(queue_dir, 'results', shard['id'])
+            np.savez(result + '.tmp.npz', accuracies=accuracies, subjects=shard['subjects'], sets=shard['sets'])
+            os.replace(result + '.tmp.npz', result + '.npz')
+            os.replace(running, os.path.join(queue_dir, 'done', shard['id'] + '.json'))
+            print("Shard {0} finished".format(shard['id']))
+        processed += 1
+    return processed
+
+
+def status(queue_dir):
+    """Shard ids of the queue by state"""
+    return {state: sorted(name[:-len('.json')] for name in os.listdir(os.path.join(queue_dir, state))
+                          if name.endswith('.json'))
+            for state in STATES}
+
+
+def requeue(queue_dir, states=('failed',)):
+    """
+    Put the shards of states back into pending/, e.g. the failed ones or the
+    running ones of a worker that was killed.
+    Returns:
+            list of the requeued shard ids
+    """
+    requeued = []
+    for state in states:
+        for shard_id in status(queue_dir)[state]:
+            os.replace(os.path.join(queue_dir, state, shard_id + '.json'),
+                       os.path.join(queue_dir, 'pending', shard_id + '.json'))
+            requeued.append(shard_id)
+    return requeued
+
+
+def merge(queue_dir):
+    """
+    Assemble the results of all shards of a queue.
+    Returns:
+            accuracies (n_sets x n_subjects), names of the decoding sets, subject columns ('sub-XX')
+    """
+    with open(os.path.join(queue_dir, 'plan.json')) as f:
+        plan_content = json.load(f)
+    subjects = plan_content['subjects']
+    missing = [shard_id for shard_id in plan_content['shards']
+               if not os.path.exists(os.path.join(queue_dir, 'results', shard_id + '.npz'))]
+    if missing:
+        raise ValueError('{0} of {1} shards are not done: {2}'.format(
+            len(missing), len(plan_content['shards']), ', '.join(missing)))
+    accuracies = np.full((len(plan_content['sets']), len(subjects)), np.nan)
+    column = {sub: ind for ind, sub in enumerate(subjects)}
+    for shard_id in plan_content['shards']:
+        with np.load(os.path.join(queue_dir, 'results', shard_id + '.npz')) as result:
+            start, stop = result['sets']
+            accuracies[start:stop, [column[sub] for sub in result['subjects']]] = result['accuracies']
+    return accuracies, plan_content['sets'], ['sub-{0:02d}'.format(sub) for sub in subjects]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sharded runs of the python pipeline with a file-based work queue")
+    commands = parser.add_subparsers(dest='command')
+    plan_parser = commands.add_parser('plan', help="Split a run into shards")
+    plan_parser.add_argument("cfg_file", help="JSON file with the configuration information")
+    plan_parser.add_argument("queue", help="Folder of the work queue")
+    plan_parser.add_argument("--subject_shards", type=int, default=1, help="Number of groups of subjects")
+    plan_parser.add_argument("--set_shards", type=int, default=1, help="Number of groups of decoding sets")
+    plan_parser.add_argument("--decoder", default="svc", choices=["svc", "lda", "ncm"])
+    plan_parser.add_argument("--seed", type=int, help="Seed for the random variables of each subject (random if unset)")
+    work_parser = commands.add_parser('work', help="Process pending shards until the queue is empty")
+    work_parser.add_argument("queue", help="Folder of the work queue")
+    work_parser.add_argument("--max_shards", type=int, help="Stop after this many shards")
+    work_parser.add_argument("--cache_dir", help="Use the cache of parsed tsv files in this folder")
+    status_parser = commands.add_parser('status', help="Show the shards by state")
+    status_parser.add_argument("queue", help="Folder of the work queue")
+    requeue_parser = commands.add_parser('requeue', help="Put failed (and with --running, running) shards back in the queue")
+    requeue_parser.add_argument("queue", help="Folder of the work queue")
+    requeue_parser.add_argument("--running", help="Also requeue running shards (of killed workers)", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        shards = plan(args.cfg_file, args.queue, args.subject_shards, args.set_shards, args.decoder, args.seed)
+        print("{0} shards in {1}".format(len(shards), args.queue))
+    elif args.command == 'work':
+        cache = None
+        if args.cache_dir:
+            import tsv_cache
+            cache = tsv_cache.TSVCache(args.cache_dir, tsv_cache.DEFAULT_SIZE_MB)
+        print("Processed {0} shards".format(work(args.queue, cache, args.max_shards)))
+    elif args.command == 'status':
+        for state, shards in status(args.queue).items():
+            print("{0}: {1}".format(state, len(shards)) + (" ({0})".format(', '.join(shards)) if state != 'done' and shards else ''))
+    elif args.command == 'requeue':
+        print("Requeued: {0}".format(', '.join(requeue(args.queue, ('failed', 'running') if args.running else ('failed',)))))
+    else:
+        parser.print_help()
+        sys.exit(1)
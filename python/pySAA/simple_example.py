@@ -1,21 +1,21 @@
 # coding: utf-8
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
-from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import LeaveOneGroupOut
-from sklearn import svm
 
-clf = svm.SVC(kernel='linear', C=1)
-logo = LeaveOneGroupOut()
+import decoders
+import tsv_cache
+from preparation import subject_rng
 
 
 
 def plot_cv_indices(cv, X, y, group, n_splits, lw=10):
     """Create a sample plot for indices of a cross-validation object."""
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     # Generate the training/testing visualizations for each CV split
     for ii, (tr, tt) in enumerate(cv.split(X=X, y=y, groups=group)):
@@ -46,62 +46,86 @@ def plot_cv_indices(cv, X, y, group, n_splits, lw=10):
     plt.show()
     return ax
 
-def subject2DataFrame(files):
+def subject2DataFrame(files, rng=np.random, cache=None):
     """
     Transform the files that correspond to a subject data into a DataFrame
+    rng: random generator used for the rand_n column (defaults to the global numpy state)
+    cache: tsv_cache.TSVCache with already parsed files, or None
     """
     dframes = []
     for i, file in enumerate(files):
-        df = pd.read_csv(file, sep='\t', index_col=False)
+        df = tsv_cache.read_tsv(file, cache, index_col=False)
         df['sess_ind'] = [i + 1] * len(df.index)
-        df['rand_n'] = np.random.random(len(df.index))
+        df['rand_n'] = rng.random(len(df.index))
         # The preparation of data should take place here:
         #    Expansion of ordinals, replace defaults, apply functions
         dframes.append(df)
     return pd.concat(dframes).sort_values('name')
     
 
-def process_subject(general_file, sub_ind, sessions, cv, plot_cv=True):
+def process_subject(general_file, sub_ind, sessions, cv, plot_cv=True, seed=None, decoder='svc', cache=None):
     """
     Main loop over subjects. Their information is parsed and decoded.
+    decoder: name of the backend in decoders.DECODERS used to decode the variables
     """
     path = os.path.join(general_file, "sourcedata", "sub-{0:02d}", "ses-{1:02d}", "fmri", "data.tsv")
     
     # Instead of having a general file, here the script should loop over the BIDS folder
     files = [path.format(sub_ind, sess_ind) for sess_ind in sessions]
-    result = subject2DataFrame(files)
+    result = subject2DataFrame(files, subject_rng(seed, sub_ind), cache)
     groups = result.sess_ind
     labels = result.name
     chance_level = 1.0 / len(set(labels))
-    scores = []
-    # Instead of looping over the variables that we have what could be done is to read
-    # the decoding sets from a separate file
-    for field in result:
-        data = np.array([result[field]]).T
-        score = np.mean(cross_val_score(clf, data, labels, cv=cv, groups=groups))
-        scores.append(score - chance_level)
+    # Every variable is decoded on its own; the decoding sets of a cfg file are used by
+    # the full python pipeline (decoders.decode_subject)
+    decode = decoders.get_decoder(decoder)
+    masks = np.eye(len(result.columns), dtype=bool)
+    scores = list(decode(result.to_numpy(), masks, labels, groups, cv).mean(axis=0) - chance_level)
    
     # Plot cross_validation design if requested: this should come from argument or config file
     if plot_cv:
         plot_cv_indices(cv, result, labels, groups, n_splits=len(sessions))
     return scores, list(result)
 
-def simple_process(general_file, substodo, sessions, cv):
+def _process_subject_job(args):
+    """Unpack the arguments of process_subject for a worker of the process pool"""
+    general_file, sub_ind, sessions, cv, plot_cv, seed, decoder, cache = args
+    return process_subject(general_file, sub_ind, sessions, cv, plot_cv=plot_cv, seed=seed, decoder=decoder, cache=cache)
+
+def simple_process(general_file, substodo, sessions, cv, n_jobs=1, seed=None, decoder='svc', cache=None, plot_cv=False):
     """
     Initiate a simple decoding that requires no MATLAB.
+    n_jobs: number of worker processes the subjects are distributed to.
+            1 runs the subjects serially, -1 uses all cores.
+    seed: seed for the random generator of each subject (rand_n).
+    decoder: name of the decoding backend (see decoders.DECODERS)
+    cache: tsv_cache.TSVCache with already parsed files, or None
+    plot_cv: show the cross validation design of every subject (blocks until the figure is closed),
+             in the serial and in the parallel case alike
     """
     accuracies = []
     columns = ['sub-{0:02d}'.format(i) for i in range(1, 1 + len(substodo))]
-    for sub_ind in substodo:
-        scores_subject, sets = process_subject(general_file, sub_ind, sessions, cv)
-        accuracies.append(scores_subject)
+    if n_jobs == 1:
+        for sub_ind in substodo:
+            scores_subject, sets = process_subject(general_file, sub_ind, sessions, cv, plot_cv=plot_cv, seed=seed,
+                                                   decoder=decoder, cache=cache)
+            accuracies.append(scores_subject)
+    else:
+        max_workers = None if n_jobs < 0 else n_jobs
+        jobs = [(general_file, sub_ind, sessions, cv, plot_cv, seed, decoder, cache) for sub_ind in substodo]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # map keeps the order of substodo, hence the layout of the accuracies
+            for scores_subject, sets in executor.map(_process_subject_job, jobs):
+                accuracies.append(scores_subject)
     return 100 * np.array(accuracies).T, columns, sets
 
-def run(general_file, n_subs, n_sess):
+def run(general_file, n_subs, n_sess, n_jobs=1, seed=None, decoder='svc', cache=None):
     """
     Wrapper function for the decoding process.
     """
     substodo, sessions = range(1, int(n_subs) + 1), range(1, int(n_sess) + 1)
-    accuracy_arr, sets, columns = simple_process(general_file, substodo, sessions, logo)
+    # the design is shown when the subjects run serially, as before
+    accuracy_arr, sets, columns = simple_process(general_file, substodo, sessions, LeaveOneGroupOut(),
+                                                  n_jobs, seed, decoder, cache, plot_cv=n_jobs == 1)
     df = pd.DataFrame(accuracy_arr, index=columns, columns=sets)
     return accuracy_arr.T, df, columns , sets
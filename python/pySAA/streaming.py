@@ -0,0 +1,141 @@
+"""
+ Streaming output of SAA.
+ The result of each subject is appended to a JSON lines file as soon as it is
+ decoded, so nothing is lost if a later subject fails and a run can be resumed
+ from the subjects already in the file. The partial results can be plotted at
+ any time:
+     python streaming.py output/result_partial.jsonl [output/partial.html]
+"""
+# coding: utf-8
+
+import json
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+
+class ResultStream:
+    def __init__(self, filename, resume=False):
+        """
+        Append-only JSON lines file with one record per subject.
+        Input:  filename: path of the file
+                resume: keep the records already in the file, otherwise it is emptied
+        """
+        self.filename = filename
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file = open(filename, 'a' if resume else 'w')
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        # make sure the record survives a crash of the process
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write(self, subject, sets, accuracies, seconds=None):
+        """Append the accuracies of a subject"""
+        self._write(dict(subject=subject, sets=list(sets), accuracies=[float(a) for a in accuracies],
+                         seconds=seconds))
+
+    def write_error(self, subject, error):
+        """Append a failed subject, it is decoded again when the run is resumed"""
+        self._write(dict(subject=subject, error=repr(error)))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_records(filename, sets=None):
+    """
+    Last successful record of each subject of a stream file.
+    Input:  sets: names of the decoding sets, records of other decoding sets are ignored
+                  (e.g. written before analyses.tsv was changed)
+    Returns:
+            dict subject -> record, in the order the subjects were completed
+    """
+    records = {}
+    if not os.path.exists(filename):
+        return records
+    with open(filename) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # line cut by a crash while writing
+                continue
+            if 'accuracies' in record and (sets is None or record['sets'] == list(sets)):
+                records.pop(record['subject'], None)
+                records[record['subject']] = record
+    return records
+
+
+def read_results(filename, subjects=None, sets=None):
+    """
+    Accuracies of the completed subjects of a stream file.
+    Input:  subjects: order of the subjects (columns), completion order if None
+            sets: names of the decoding sets, those of the last completed subject if None
+    Returns:
+            accuracies (n_sets x n_completed), sets, columns
+    Raises a ValueError if no subject was completed.
+    """
+    records = read_records(filename)
+    if sets is None and records:
+        sets = records[list(records)[-1]]['sets']
+    records = read_records(filename, sets)
+    columns = [sub for sub in (subjects or records) if sub in records]
+    if not columns:
+        raise ValueError('No completed subjects in {0}'.format(filename))
+    sets = records[columns[0]]['sets']
+    accuracies = np.array([records[sub]['accuracies'] for sub in columns]).T
+    return accuracies, sets, columns
+
+
+class Progress:
+    def __init__(self, total, done=0):
+        """Report the progress of a run of total subjects, done of them were already completed"""
+        self.total, self.done, self.failed = total, done, 0
+        self.start, self.processed = time.time(), 0
+
+    def update(self, subject, seconds):
+        """A subject finished in seconds"""
+        self.done += 1
+        self.processed += 1
+        elapsed = time.time() - self.start
+        remaining = self.total - self.done - self.failed
+        eta = elapsed / self.processed * remaining
+        print("[{0}/{1}] {2} finished in {3:.1f} s, about {4:.0f} s left".format(
+            self.done, self.total, subject, seconds, eta))
+
+    def fail(self, subject, error):
+        """A subject failed"""
+        self.failed += 1
+        print("[{0}/{1}] {2} FAILED: {3!r}".format(self.done, self.total, subject, error))
+        traceback.print_exc()
+
+
+def plot_partial(filename, output_html, expected_file=None, show=True):
+    """Render the heatmap and box plot of the subjects completed so far (show: open it in the browser)"""
+    import visualization
+    try:
+        accuracies, sets, columns = read_results(filename)
+    except ValueError as error:
+        print(error)
+        return None
+    df = pd.DataFrame(accuracies, index=sets, columns=columns)
+    expected_df = pd.read_csv(expected_file, sep='\t', index_col=0) if expected_file else None
+    return visualization.Visualization(accuracies, df, expected_df, output_html, columns=columns, sets=sets, show=show)
+
+
+if __name__ == '__main__':
+    stream_file = sys.argv[1]
+    output = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(stream_file)[0] + '.html'
+    plot_partial(stream_file, output)
@@ -0,0 +1,130 @@
+"""
+ On-disk cache of parsed tsv files.
+ A parsed DataFrame is stored under the hash of the content of the file and
+ the options it was read with, so it is reused as long as the file does not
+ change. To avoid hashing unchanged files, the hash is remembered together
+ with the modification time and size of each path. The cache is bounded in
+ size: the least recently used entries are removed first.
+"""
+# coding: utf-8
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pySAA')
+DEFAULT_SIZE_MB = 1024
+
+
+def file_hash(path):
+    """sha1 of the content of a file"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class TSVCache:
+    def __init__(self, directory=DEFAULT_DIR, max_mb=DEFAULT_SIZE_MB):
+        """
+        Input:  directory: folder where the parsed files are stored
+                max_mb: maximum size of the cache in MB
+        """
+        self.directory = directory
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.index_file = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+
+    def _load_index(self):
+        """path -> [mtime, size, hash] of the files seen so far"""
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        """Write the index atomically, so concurrent processes never read half of it"""
+        tmp = '{0}.{1}'.format(self.index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_file)
+
+    def _content_hash(self, path):
+        """Hash of the file, only recomputed if its modification time or size changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        index = self._load_index()
+        entry = index.get(path)
+        if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            return entry[2]
+        digest = file_hash(path)
+        index[path] = [stat.st_mtime, stat.st_size, digest]
+        self._save_index(index)
+        return digest
+
+    def read_tsv(self, path, **kwargs):
+        """
+        pd.read_csv(path, sep='\\t', **kwargs), served from the cache when the
+        file was already parsed with the same options.
+        """
+        key = hashlib.sha1('{0}{1}'.format(self._content_hash(path), sorted(kwargs.items())).encode())
+        cached = os.path.join(self.directory, key.hexdigest() + '.pkl')
+        if os.path.exists(cached):
+            try:
+                df = pd.read_pickle(cached)
+                # mark as recently used
+                os.utime(cached)
+                return df
+            except Exception:
+                # unreadable entry, e.g. written by another process at the same time
+                pass
+        df = pd.read_csv(path, sep='\t', **kwargs)
+        tmp = '{0}.{1}'.format(cached, os.getpid())
+        df.to_pickle(tmp)
+        os.replace(tmp, cached)
+        self.evict()
+        return df
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its maximum size"""
+        entries = []
+        for f in os.listdir(self.directory):
+            f = os.path.join(self.directory, f)
+            try:
+                stat = os.stat(f)
+            except OSError:
+                # removed by another process meanwhile
+                continue
+            if f.endswith('.pkl'):
+                entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove the entries and the index of the cache, other files of the directory are kept"""
+        for f in os.listdir(self.directory):
+            # entries, the index and their temporary files (<name>.<pid>)
+            if f.endswith('.pkl') or '.pkl.' in f or f == 'index.json' or f.startswith('index.json.'):
+                try:
+                    os.remove(os.path.join(self.directory, f))
+                except OSError:
+                    pass
+
+
+def read_tsv(path, cache=None, **kwargs):
+    """Read a tsv file through cache if given, directly with pandas otherwise"""
+    if cache is None:
+        return pd.read_csv(path, sep='\t', **kwargs)
+    return cache.read_tsv(path, **kwargs)
@@ -5,16 +5,67 @@
  author: Daniel Vargas
  supervisor: Kai Goergen
 """
+import json
+import os
+
 import bokeh.palettes as plt
 import numpy as np
 import pandas as pd
-from scipy.stats import ttest_ind as ttest
 
 #from bokeh.embed import components
 from bokeh.io import output_file, output_notebook, reset_output, save
 from bokeh.layouts import column, row
-from bokeh.models import BasicTicker, ColorBar, ColumnDataSource, LabelSet, LinearColorMapper 
+from bokeh.models import BasicTicker, ColorBar, ColumnDataSource, CustomJS, FactorRange, LabelSet, LinearColorMapper
 from bokeh.plotting import figure, show
+from bokeh.transform import linear_cmap
+
+import permutation
+
+# larger grids are shown as block means in the heat map
+MAX_HEATMAP_ROWS = 200
+MAX_HEATMAP_COLUMNS = 200
+# scatter plots with more points are drawn with webgl
+WEBGL_POINTS = 5000
+# scatter plots with more subjects have no legend
+LEGEND_SUBJECTS = 20
+
+
+def summary_statistics(accuracies):
+    """
+    Box plot statistics of all decoding sets at once.
+    Input:  accuracies: numpy array n_decoding_sets x n_subjects
+    Returns:
+            dict with numpy arrays (n_decoding_sets) q1, q2, q3, qmin, qmax, upper and lower whisker, mean
+    """
+    accuracies = np.asarray(accuracies, dtype=float)
+    qmin, q1, q2, q3, qmax = np.nanpercentile(accuracies, [0, 25, 50, 75, 100], axis=1)
+    iqr = q3 - q1
+    return dict(q1=q1, q2=q2, q3=q3, qmin=qmin, qmax=qmax, upper=np.minimum(qmax, q3 + 1.5 * iqr),
+                lower=np.maximum(qmin, q1 - 1.5 * iqr), mean=np.nanmean(accuracies, axis=1))
+
+
+def block_starts(n, max_blocks):
+    """First index of each block when n items are grouped into at most max_blocks contiguous blocks"""
+    n_blocks = min(n, max_blocks)
+    return np.arange(n_blocks) * n // n_blocks
+
+
+def aggregate(accuracies, row_starts, column_starts):
+    """Mean of the blocks of accuracies that start at row_starts x column_starts, nan are ignored"""
+    accuracies = np.asarray(accuracies, dtype=float)
+    valid = ~np.isnan(accuracies)
+    def block_sum(values):
+        return np.add.reduceat(np.add.reduceat(values, row_starts, axis=0), column_starts, axis=1)
+    with np.errstate(invalid='ignore'):
+        return block_sum(np.where(valid, accuracies, 0.)) / block_sum(valid.astype(float))
+
+
+def block_labels(labels, starts):
+    """Axis label of each block: its label, or its first and last label"""
+    stops = list(starts[1:]) + [len(labels)]
+    return [str(labels[start]) if stop - start == 1 else '{0} ... {1}'.format(labels[start], labels[stop - 1])
+            for start, stop in zip(starts, stops)]
+
 
 class Visualization:
     def __init__(self, accuracies, df, expected_df, output_name, **kwargs):
@@ -25,10 +76,17 @@ class Visualization:
                 df: pandas DataFrame with the accuracies
                 expected_df: pandas DataFrame with the expected values
                 output_name: path to the file where the output figure will be saved
+                In kwargs (optional):
+                max_rows, max_columns: size of the heat map above which blocks are aggregated
+                show: open the figure in the browser (default), otherwise it is only saved
+                lazy: write the accuracies of every block of rows to <output>_detail/ and load
+                      them into a detail heat map when the block is clicked (the folder must be
+                      served over http, e.g. python -m http.server in the output folder)
         """
         reset_output()
         output_file(output_name)
-        self.accuracies = accuracies
+        self.output_name = output_name
+        self.accuracies = np.asarray(accuracies, dtype=float)
         self.df = df
         self.expected_df = expected_df
         self.visualize(kwargs)
@@ -44,21 +102,26 @@ class Visualization:
         p1 = self.heatmap(kwargs)
         p2, p_values_num = self.box_plot(kwargs)
         r1 = row(p1, p2, sizing_mode="fixed")
+        if kwargs.get("lazy"):
+            r1 = column(r1, self.detail_heatmap(kwargs, p1))
         # expected value plots
         results = dict(
             accuracies = pd.DataFrame(self.accuracies, index=kwargs["sets"], columns=kwargs["columns"]),
             p_values = pd.DataFrame(p_values_num, index=kwargs["sets"], columns=["p_values"])
         )
+        render = show if kwargs.get("show", True) else save
         if self.expected_df is not None:
             r2 = self.plot_expected(results)
-            show(column(r1, r2))
+            render(column(r1, r2))
         else:
-            show(r1)
+            render(r1)
 
 
     def heatmap(self, params):
         """
         Plot a 2D array of accuracies as a heat map using bokeh.
+        Grids larger than params max_rows x max_columns are shown as the means of blocks of
+        neighbouring decoding sets and subjects.
         Input: 
                 accuracies: numpy.array of dimensions n x m, n=number of decoding sets, m=number of subjects
                 In params:
@@ -68,17 +131,32 @@ class Visualization:
                 bokeh.figure object
         """
         #Get arguments
-        accuracies, x_range, y_range = self.accuracies, params["columns"], params["sets"]
+        accuracies, columns, sets = self.accuracies, params["columns"], params["sets"]
+        self.row_starts = block_starts(len(sets), params.get("max_rows", MAX_HEATMAP_ROWS))
+        column_starts = block_starts(len(columns), params.get("max_columns", MAX_HEATMAP_COLUMNS))
+        if len(self.row_starts) < len(sets) or len(column_starts) < len(columns):
+            image = aggregate(accuracies, self.row_starts, column_starts)
+            title = "Mean of blocks of up to {0} sets x {1} subjects".format(
+                -(-len(sets) // len(self.row_starts)), -(-len(columns) // len(column_starts)))
+        else:
+            image, title = accuracies, None
+        x_range, y_range = block_labels(columns, column_starts), block_labels(sets, self.row_starts)
         # define color
-        color_mapper = LinearColorMapper(palette="Greys256", low=accuracies.min(), high=accuracies.max())
+        self.color_mapper = color_mapper = LinearColorMapper(palette="Greys256", low=np.nanmin(accuracies),
+                                                             high=np.nanmax(accuracies))
         # List for hover tool
         TOOLTIPS = [("accuracy", "@image")]
         # initialise figure
-        p = figure(plot_width=600, plot_height=400, x_range=x_range, y_range=y_range, tooltips=TOOLTIPS)
+        p = figure(plot_width=600, plot_height=400, x_range=x_range, y_range=y_range, tooltips=TOOLTIPS, title=title)
         p.xaxis.axis_label = "Subject id"
         p.yaxis.axis_label = "Decoding Variables"
-        # plot image
-        p.image(image=[accuracies], color_mapper=color_mapper, x=[0], y=[0], dw=[len(x_range)], dh=[len(y_range)])
+        if len(x_range) > 50:
+            p.xaxis.major_label_text_font_size = "0pt"
+        if len(y_range) > 50:
+            p.yaxis.major_label_text_font_size = "0pt"
+        # plot image, single precision halves the size of the html
+        p.image(image=[image.astype(np.float32)], color_mapper=color_mapper, x=[0], y=[0],
+                dw=[len(x_range)], dh=[len(y_range)])
         # plot color bar
         color_bar = ColorBar(color_mapper=color_mapper, ticker=BasicTicker(), location=(0,0))
         p.add_layout(color_bar, 'right')
@@ -87,92 +165,64 @@ class Visualization:
         # script, div = components(plot)
         return p
 
+    def detail_heatmap(self, params, heatmap):
+        """
+        Lazy loading of the full resolution: the accuracies of every block of rows of the
+        heat map are written to <output>_detail/block_<i>.json, a click on a block of the
+        heat map fetches its file and shows all its sets and subjects in the returned figure.
+        """
+        columns, sets = [str(c) for c in params["columns"]], [str(s) for s in params["sets"]]
+        detail_dir = os.path.splitext(self.output_name)[0] + '_detail'
+        os.makedirs(detail_dir, exist_ok=True)
+        stops = list(self.row_starts[1:]) + [len(sets)]
+        for block, (start, stop) in enumerate(zip(self.row_starts, stops)):
+            values = np.round(self.accuracies[start:stop], 4)
+            content = dict(sets=sets[start:stop], columns=columns,
+                           accuracies=np.where(np.isnan(values), None, values).tolist())
+            with open(os.path.join(detail_dir, 'block_{0}.json'.format(block)), 'w') as f:
+                json.dump(content, f)
+        # the first block is embedded, the others are fetched on demand
+        stop = stops[0]
+        source = ColumnDataSource(data=dict(x=np.tile(columns, stop), y=np.repeat(sets[:stop], len(columns)),
+                                            value=self.accuracies[:stop].ravel()))
+        p = figure(plot_width=1200, plot_height=300, x_range=FactorRange(factors=columns),
+                   y_range=FactorRange(factors=sets[:stop]), tooltips=[("set", "@y"), ("subject", "@x"), ("accuracy", "@value")],
+                   title="Click on the heat map to show a block of decoding sets")
+        p.rect('x', 'y', 1, 1, source=source, fill_color=dict(field='value', transform=self.color_mapper), line_color=None)
+        p.xaxis.major_label_orientation = np.pi/2
+        callback = CustomJS(args=dict(source=source, detail=p, n_blocks=len(self.row_starts),
+                                      folder=os.path.basename(detail_dir)), code="""
+            const block = Math.floor(cb_obj.y);
+            if (block < 0 || block >= n_blocks) return;
+            fetch(folder + '/block_' + block + '.json').then(r => r.json()).then(d => {
+                const x = [], y = [], value = [];
+                for (let i = 0; i < d.sets.length; i++)
+                    for (let j = 0; j < d.columns.length; j++) {
+                        x.push(d.columns[j]); y.push(d.sets[i]); value.push(d.accuracies[i][j]);
+                    }
+                detail.y_range.factors = d.sets;
+                source.data = {x: x, y: y, value: value};
+            });
+        """)
+        heatmap.js_on_event('tap', callback)
+        return p
+
     def box_plot(self, params):
         """
-        Show a box plot with bokeh from the information contained in df
+        Show a box plot with bokeh from the information contained in df.
+        The statistics of all decoding sets are computed at once and all glyphs share one data source.
         Input:
                 In params:
                 sets: Iterable with strings of each decoding set
+                p_values: optional one-sided p-values of each decoding set (e.g. from
+                          permutation.group_permutation_test). If missing, a sign-flip
+                          permutation test of the accuracies is run.
         Returns:
                 bokeh.figure object after running a 2nd level analysis
         """
-
-        def get_quartiles(df):
-            """
-            Compute quartiles and mean from a DataFrame df
-            """
-            df = df.T
-            q1   = df.quantile(q=0.25)
-            q2   = df.quantile(q=0.50)
-            q3   = df.quantile(q=0.75)
-
-            iqr = q3 - q1
-            upper = q3 + 1.5*iqr
-            lower = q1 - 1.5*iqr
-
-            qmin = df.quantile(q=0.00)
-            qmax = df.quantile(q=1.00)
-
-            upper.score = [min([x,y]) for (x,y) in zip(list(qmax),upper)]
-            lower.score = [max([x,y]) for (x,y) in zip(list(qmin),lower)]
-            mean = df.mean()
-            return q1, q2, q3, qmin, qmax, upper, lower, mean
-
-        def plot_boxes(p, sets, q1, q2, q3, p_values):
-            """Plot boxes from plot box"""
-            source1 = ColumnDataSource(data=dict(y=sets, right=q3, left=q2, p_values=p_values))
-            source2 = ColumnDataSource(data=dict(y=sets, right=q2, left=q1, p_values=p_values))
-            p.hbar('y', 0.1, 'right', 'left', fill_color="darkorchid", line_color="black", source=source1)
-            p.hbar('y', 0.1, 'right', 'left', fill_color="darkcyan", line_color="black", source=source2)
-            return p
-
-        def plot_stems(p, upper, lower, q1, q2, q3, p_values):
-            """Plot stems from box plot"""
-            source1 = ColumnDataSource(data=dict(x0=upper, x1=q3, y=sets, p_values=p_values))
-            source2 = ColumnDataSource(data=dict(x0=lower, x1=q1, y=sets, p_values=p_values))
-            p.segment('x0', 'y', 'x1', 'y', source=source1, line_color="black")
-            p.segment('x0', 'y', 'x1', 'y', source=source2, line_color="black")
-            return p
-
-        def plot_whiskers(p, upper, lower, p_values):
-            """Plot whiskers from blox plot"""
-            source1 = ColumnDataSource(data=dict(x=lower, y=sets, p_values=p_values))
-            source2 = ColumnDataSource(data=dict(x=upper, y=sets, p_values=p_values))
-            p.rect("x", "y", 0.01, 0.1, source=source1, line_color="black")
-            p.rect("x", "y", 0.01, 0.1, source=source2, line_color="black")
-            return p
-
-        def plot_circles(p, n_subs, mean, sets, p_values_num):
-            """Plot the mean of data as a circle (annulus)"""
-            # circles
-            if n_subs > 1:
-                bonferroni_low  = 0.05 / len(sets)
-                bonferroni_high = 1 - bonferroni_low
-                intervals = (bonferroni_low, 0.05, 0.1, 0.9, 0.95, bonferroni_high)
-                colors = ('red', 'black', 'black', 'grey', 'cyan', 'cyan', 'blue')
-                txtmarker = ('**', '*', '^', '', '^', '*b', '**b')
-                p_color = [colors[np.where(p <= intervals)[0][0]] for p in p_values_num]
-                p_marker = [txtmarker[np.where(p <= intervals)[0][0]] for p in p_values_num]
-                p_values = ["{0:0.3f}".format(p) for p in p_values_num]
-                
-            else:
-                p_values = list(map(str, p_values_num))
-            source = ColumnDataSource(data=dict(x=mean, y=sets, p_values=p_values, units_default=["screen"] * len(mean)))
-            p.annulus("x", "y", 0.05, 0.3, source=source, fill_color="white", line_color="black")
-            p.circle("x", "y", size=0., source=source, fill_color="red", line_color="black")
-            # labels
-            if n_subs > 1:
-                p_values = list(map(lambda x, y: x+y, p_values, p_marker))
-                source = ColumnDataSource(data=dict(x=mean, y=sets, p_values=p_values, color=p_color))
-            else:
-                source = ColumnDataSource(data=dict(x=mean, y=sets, p_values=p_values, color=['black']*len(sets)))
-            labels = LabelSet(x='x', y='y', text='p_values', level='glyph', text_color="color", \
-                              source=source, x_offset=1, y_offset=8, render_mode='canvas')
-            p.add_layout(labels)
-            return p
-
         # Get arguments
         df, sets = self.df, params["sets"]
+        n_subs = len(df.T)
 
         #Hover tool
         TOOLTIPS = [
@@ -180,32 +230,52 @@ class Visualization:
             ("p_values", "@p_values")
         ]
         # Quartile information
-        q1, q2, q3, qmin, qmax, upper, lower, mean = get_quartiles(df)
-        # Compute t-test if there is more than one subject
-        if len(df.T) > 1:
-            t_statistic, p_values_num = ttest(df.T, np.zeros_like(df.T))
-            p_values_num = np.nan_to_num(p_values_num)
+        stats = summary_statistics(df.to_numpy())
+        # Compute one-sided permutation p-values if there is more than one subject
+        if params.get("p_values") is not None:
+            p_values_num = np.asarray(params["p_values"])
+        elif n_subs > 1:
+            p_values_num = permutation.sign_flip_test(df.to_numpy())['p_values']
+        else:
+            p_values_num = np.full(len(sets), np.nan)
+        if n_subs > 1:
             p_values = ["{0:0.3f}".format(p) for p in p_values_num]
+            bonferroni_low  = 0.05 / len(sets)
+            bonferroni_high = 1 - bonferroni_low
+            intervals = (bonferroni_low, 0.05, 0.1, 0.9, 0.95, bonferroni_high)
+            colors = np.array(('red', 'black', 'black', 'grey', 'cyan', 'cyan', 'blue'))
+            txtmarker = np.array(('**', '*', '^', '', '^', '*b', '**b'))
+            category = np.searchsorted(intervals, p_values_num)
+            labels = [p + marker for p, marker in zip(p_values, txtmarker[category])]
+            label_colors = colors[category]
         else:
-            p_values_num = [float("nan")] * len(sets) 
-            p_values = ["n/a"] * len(sets)
-        p = figure(plot_width=600, plot_height=400, background_fill_color="#efefef", y_range=sets, tooltips=TOOLTIPS)
+            p_values = labels = ["n/a"] * len(sets)
+            label_colors = ['black'] * len(sets)
+        source = ColumnDataSource(data=dict(y=list(sets), p_values=p_values, labels=labels, color=label_colors,
+                                            **{name: stats[name] for name in ('q1', 'q2', 'q3', 'upper', 'lower', 'mean')}))
+        p = figure(plot_width=600, plot_height=400, background_fill_color="#efefef", y_range=list(sets), tooltips=TOOLTIPS)
 
         # boxes
-        p = plot_boxes(p, sets, q1, q2, q3, p_values)
-
+        p.hbar('y', 0.1, 'q3', 'q2', fill_color="darkorchid", line_color="black", source=source)
+        p.hbar('y', 0.1, 'q2', 'q1', fill_color="darkcyan", line_color="black", source=source)
         # stems
-        p = plot_stems(p, upper.score, lower.score, q1, q2, q3, p_values)
-
+        p.segment('upper', 'y', 'q3', 'y', source=source, line_color="black")
+        p.segment('lower', 'y', 'q1', 'y', source=source, line_color="black")
         # whiskers
-        p = plot_whiskers(p, upper.score, lower.score, p_values)
-        # circles
-        p = plot_circles(p, len(df.T), mean, sets, p_values_num)
+        p.rect('lower', 'y', 0.01, 0.1, source=source, line_color="black")
+        p.rect('upper', 'y', 0.01, 0.1, source=source, line_color="black")
+        # circles at the mean
+        p.annulus('mean', 'y', 0.05, 0.3, source=source, fill_color="white", line_color="black")
+        p.circle('mean', 'y', size=0., source=source, fill_color="red", line_color="black")
+        # labels
+        if len(sets) <= MAX_HEATMAP_ROWS:
+            p.add_layout(LabelSet(x='mean', y='y', text='labels', level='glyph', text_color="color",
+                                  source=source, x_offset=1, y_offset=8, render_mode='canvas'))
 
         # grid
         p.xaxis.axis_label = "Accuracy minus chance"
         p.yaxis.axis_label = "Decoding variables"
-        p.yaxis.major_label_text_font_size="8pt"
+        p.yaxis.major_label_text_font_size = "8pt" if len(sets) <= 50 else "0pt"
         p.ygrid.grid_line_color = None
         p.xgrid.grid_line_color = "white"
         p.grid.grid_line_width = 2
@@ -215,32 +285,51 @@ class Visualization:
     def create_fig(self, data, expected_series, test_str):
         """
         Scatter plot of the data.get(test_str) and expected_series.
+        All subjects are drawn from one data source.
         Input:  data: dictionary of DataFrames of real data
                 expected_series: DataSeries of expected values
                 test_str: key of the data dictionary to select a dataframe
 
         """
         test = data.get(test_str)
-        sizes = (15 + np.abs(test.T - expected_series)**1.5).T
+        sets, subjects = [str(s) for s in test.index], [str(s) for s in test.columns]
+        values = test.to_numpy(dtype=float)
+        expected = expected_series.reindex(test.index).to_numpy(dtype=float)
+        # numeric columns only (positions on the categorical axis and subject indices),
+        # which are stored in binary form in the html
+        n_sets, n_subs = values.shape
+        columns = dict(x=np.repeat(np.arange(n_sets) + 0.5, n_subs), y=values.ravel(),
+                       subject_ind=np.tile(np.arange(n_subs), n_sets),
+                       size=(15 + np.abs(values - expected[:, None])**1.5).ravel(),
+                       expected=np.repeat(expected, n_subs))
+        columns = {name: np.asarray(value, dtype=np.float32) for name, value in columns.items()}
+        # names of the sets and subjects only for small plots
+        small = values.size <= WEBGL_POINTS
+        if small:
+            columns.update(set=np.repeat(sets, n_subs), subject=np.tile(subjects, n_sets))
+        source = ColumnDataSource(data=columns)
+        color = linear_cmap('subject_ind', plt.viridis(256), 0, max(n_subs - 1, 1))
+        legend = dict(legend_group='subject') if small and n_subs <= LEGEND_SUBJECTS else {}
 
         TOOLTIPS = [
-                ("Decoding set", "@x"),
+                ("Decoding set", "@set" if small else "@x{0}"),
+                ("subject", "@subject" if small else "@subject_ind"),
                 (test_str, "@y"),
                 ("expected", "@expected")
         ]
 
-        p = figure(plot_width=600, plot_height=400, x_range=list(test.index), tooltips=TOOLTIPS)
-        color = plt.viridis(len(test.T))
-        for i, subj in enumerate(test):
-            source=ColumnDataSource(data=dict(x=list(test.index),y=test[subj], size=sizes[subj], expected=expected_series))
-            p.circle('x', 'y', legend = subj, color=color[i], source=source, size='size', alpha=0.75, \
-                    muted_color=color[i], muted_alpha=0.2,)
-        p.scatter('x', 'expected', source=source, color='red', marker='*', legend='expected_df',\
-                 muted_color=color[i], muted_alpha=0.2, size=10)
+        p = figure(plot_width=600, plot_height=400, x_range=sets, tooltips=TOOLTIPS,
+                   output_backend="webgl" if values.size > WEBGL_POINTS else "canvas")
+        p.circle('x', 'y', color=color, source=source, size='size', alpha=0.75, muted_alpha=0.2, **legend)
+        expected_source = ColumnDataSource(data=dict(x=sets, expected=expected))
+        p.scatter('x', 'expected', source=expected_source, color='red', marker='*', legend_label='expected_df',
+                  muted_alpha=0.2, size=10)
 
         p.xaxis.axis_label = 'Decoding sets'
         p.yaxis.axis_label = test_str
         p.xaxis.major_label_orientation = np.pi/4
+        if len(sets) > 50:
+            p.xaxis.major_label_text_font_size = "0pt"
         p.legend.click_policy="mute"
         return p
 
@@ -254,4 +343,15 @@ class Visualization:
             p = self.create_fig(results, self.expected_df[test_str], test_str)
             plots.append(p)
         r = row(*plots, sizing_mode="fixed")
-        return r
\ No newline at end of file
+        return r
+
+def visualize_store(directory, output_name, expected_df=None):
+    """
+    Plot the subjects completed so far in a result store (see result_store.py).
+    The accuracies are read lazily from the memory-mapped files.
+    """
+    from result_store import ResultStore
+    store = ResultStore(directory)
+    accuracies, columns = store.completed_accuracies()
+    df = pd.DataFrame(accuracies, index=store.sets, columns=columns)
+    return Visualization(accuracies, df, expected_df, output_name, columns=columns, sets=store.sets)